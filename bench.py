@@ -0,0 +1,127 @@
+# Micro-benchmarks for the bot's hot paths. Run with: python bench.py
+import gc
+import sys
+import time
+import timeit
+import tracemalloc
+from datetime import datetime
+
+import main
+
+def measure(label, func, number=20000):
+    # Allocated bytes per call (peak traced memory while the results are kept alive)
+    gc.collect()
+    tracemalloc.start()
+    kept = [func() for _ in range(1000)]
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    seconds = timeit.timeit(func, number=number)
+    print(f"{label:<32} {seconds / number * 1e6:8.2f} us/call {peak / 1000:10.0f} B/call")
+
+def bench_keyboards():
+    print("Keyboards and static texts (one update renders about one keyboard):")
+    main.build_ui_cache()
+    cases = [
+        ('main_menu', lambda: main.build_main_menu_keyboard(), lambda: main.get_main_menu_keyboard()),
+        ('back', main.build_back_button, main.get_back_button),
+        ('withdrawal_amount', main.build_withdrawal_amount_keyboard, main.get_withdrawal_amount_keyboard),
+        ('redeem_amount', main.build_redeem_amount_keyboard, main.get_redeem_amount_keyboard),
+        ('admin', main.build_admin_keyboard, main.get_admin_keyboard),
+        ('how_to_earn_text', main.build_how_to_earn_text, lambda: main.get_ui('how_to_earn_text')),
+    ]
+    for name, build, cached in cases:
+        measure(f"{name} (rebuilt)", build)
+        measure(f"{name} (cached)", cached)
+
+def traced_size(build):
+    gc.collect()
+    tracemalloc.start()
+    data = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return data, size
+
+def bench_user_records(count=1_000_000):
+    print(f"User records ({count:,} synthetic users, every 10th user referred by an earlier one):")
+    now = time.time()
+
+    def build_dicts():
+        # The original representation: a dict per user with datetimes and a referral list
+        records = {}
+        for user_id in range(count):
+            records[user_id] = {
+                'balance': user_id % 500,
+                'referrals': [],
+                'referred_by': None,
+                'join_date': datetime.fromtimestamp(now - user_id),
+                'total_earned': user_id % 300,
+                'total_withdrawn': user_id % 200,
+                'last_active': datetime.fromtimestamp(now - user_id % 86400)
+            }
+            if user_id % 10 == 0 and user_id:
+                referrer_id = user_id // 10
+                records[referrer_id]['referrals'].append(user_id)
+                records[user_id]['referred_by'] = referrer_id
+        return records
+
+    def build_records():
+        records = {}
+        for user_id in range(count):
+            records[user_id] = main.UserRecord(user_id % 500, 0, 0, int(now - user_id), int(now - user_id % 86400),
+                                               user_id % 300, user_id % 200)
+            if user_id % 10 == 0 and user_id:
+                referrer_id = user_id // 10
+                records[referrer_id].referral_count += 1
+                records[user_id].referred_by = referrer_id
+        return records
+
+    for label, build in (('dict per user', build_dicts), ('UserRecord', build_records)):
+        records, size = traced_size(build)
+        started = time.perf_counter()
+        for user_id in range(1, count, 97):
+            # The duplicate-referral check done on every referred /start
+            if isinstance(records[user_id], dict):
+                user_id in records[user_id // 10]['referrals']
+            else:
+                records[user_id].referred_by != 0
+        check = (time.perf_counter() - started) / len(range(1, count, 97)) * 1e9
+        print(f"{label:<32} {size / 2**20:8.1f} MiB {size / count:8.1f} B/user {check:8.0f} ns/referral check")
+        del records
+
+def bench_referral_graph(count=1_000_000, fanout=3):
+    print(f"Referral graph ({count:,} users, each referred by an earlier one, fanout {fanout}):")
+    now = int(time.time())
+    main.users.clear()
+    main.users[1] = main.UserRecord(join_ts=now)
+    for user_id in range(2, count + 1):
+        main.users[user_id] = main.UserRecord(referred_by=(user_id - 2) // fanout + 1, join_ts=now)
+    recent = [((user_id - 2) // fanout + 1, now - user_id % (7 * 86400)) for user_id in range(2, count + 1)]
+
+    started = time.perf_counter()
+    main.referral_graph.rebuild(recent)
+    print(f"{'rebuild on load':<32} {time.perf_counter() - started:8.2f} s")
+
+    # New leaf referrals at the bottom of the tree walk the full ancestor path
+    added = 10000
+    started = time.perf_counter()
+    for user_id in range(count + 1, count + added + 1):
+        referrer_id = user_id // 7 + 1
+        main.users[user_id] = main.UserRecord(referred_by=referrer_id, join_ts=now)
+        main.referral_graph.add(referrer_id, user_id, now)
+    print(f"{'add referral':<32} {(time.perf_counter() - started) / added * 1e6:8.2f} us/call "
+          f"(depth {main.referral_graph.depth(count + added)})")
+
+    for label, hours in (('top referrers, 1h', 1), ('top referrers, 7d', 7 * 24)):
+        started = time.perf_counter()
+        main.referral_graph.top(hours, now)
+        print(f"{label:<32} {(time.perf_counter() - started) * 1000:8.2f} ms")
+    main.users.clear()
+    main.referral_graph.clear()
+
+if __name__ == '__main__':
+    bench_keyboards()
+    print()
+    bench_user_records(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
+    print()
+    bench_referral_graph(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
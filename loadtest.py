@@ -0,0 +1,301 @@
+# Offline load test: drives the real handlers and update pipeline with synthetic
+# updates against an in-process fake Bot API. Run with: python loadtest.py --users 5000
+# Add --webhook to deliver the updates as HTTP POSTs to the bot's webhook server.
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import secrets
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import httpx
+from telegram import Update
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters
+from telegram.request import BaseRequest
+
+import main
+
+BOT_INFO = {'id': 1, 'is_bot': True, 'first_name': 'Earn4Cash', 'username': main.BOT_USERNAME}
+
+# Answers Bot API calls locally after a configurable delay, so handler latency
+# includes realistic network waits without touching Telegram
+class FakeBotAPI(BaseRequest):
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.message_ids = itertools.count(1)
+        self.calls = {}
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def message(self, chat_id, text='') -> dict:
+        return {'message_id': next(self.message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': text}
+
+    async def do_request(self, url: str, method: str, request_data=None, **timeouts) -> tuple:
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+        params = request_data.parameters if request_data else {}
+        if api_method == 'getMe':
+            result = BOT_INFO
+        elif api_method == 'getChatMember':
+            result = {'status': 'member', 'user': {'id': params['user_id'], 'is_bot': False, 'first_name': 'User'}}
+        elif api_method == 'getChat':
+            result = {'id': params['chat_id'], 'type': 'private', 'first_name': f"User{params['chat_id']}",
+                      'accent_color_id': 0, 'max_reaction_count': 11}
+        elif api_method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            result = self.message(params.get('chat_id', 0), params.get('text', ''))
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+# Synthetic updates, shaped like the ones Telegram sends
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def message(self, user_id: int, text: str) -> dict:
+        message = {'message_id': next(self.message_ids), 'date': int(time.time()), 'text': text,
+                   'chat': {'id': user_id, 'type': 'private'},
+                   'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return message
+
+    def start(self, user_id: int, referrer_id: int = 0) -> Update:
+        text = f"/start {referrer_id}" if referrer_id else "/start"
+        return Update.de_json({'update_id': next(self.update_ids), 'message': self.message(user_id, text)}, self.bot)
+
+    def text(self, user_id: int, text: str) -> Update:
+        return Update.de_json({'update_id': next(self.update_ids), 'message': self.message(user_id, text)}, self.bot)
+
+    def callback(self, user_id: int, data: str) -> Update:
+        message = self.message(user_id, '')
+        message['from'] = BOT_INFO
+        query = {'id': str(next(self.update_ids)), 'chat_instance': str(user_id), 'data': data, 'message': message,
+                 'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}}
+        return Update.de_json({'update_id': next(self.update_ids), 'callback_query': query}, self.bot)
+
+def signup_updates(factory: UpdateFactory, count: int, fanout: int):
+    # Users join in id order, each referred by an earlier user, which builds
+    # referral chains count / fanout levels wide
+    for user_id in range(1, count + 1):
+        yield factory.start(user_id, (user_id - 1) // fanout if user_id > fanout else 0)
+
+def activity_updates(factory: UpdateFactory, count: int, withdraw_every: int):
+    for user_id in range(1, count + 1):
+        yield factory.callback(user_id, 'daily_bonus')
+        yield factory.callback(user_id, 'check_balance')
+        yield factory.callback(user_id, 'leaderboard')
+        if user_id % withdraw_every == 0:
+            yield factory.callback(user_id, 'withdraw')
+            yield factory.callback(user_id, f"amount_{main.WITHDRAWAL_AMOUNTS[0]}")
+            yield factory.text(user_id, f"user{user_id}@upi")
+        else:
+            yield factory.callback(user_id, 'my_stats')
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# Stands in for Telegram in webhook mode: POSTs each update as JSON with the
+# secret header, on a few parallel connections. A user's updates always use the
+# same connection, so they arrive in order as they would from Telegram.
+class WebhookSender:
+    def __init__(self, url: str, secret: str, connections: int):
+        self.url = url
+        self.secret = secret
+        self.connections = connections
+        self.rejected = 0
+
+    async def post(self, client: httpx.AsyncClient, update: Update, secret: str = None) -> int:
+        headers = {'Content-Type': 'application/json',
+                   'X-Telegram-Bot-Api-Secret-Token': self.secret if secret is None else secret}
+        response = await client.post(self.url, content=update.to_json(), headers=headers)
+        return response.status_code
+
+    async def send(self, updates) -> int:
+        lanes = [[] for _ in range(self.connections)]
+        for update in updates:
+            lanes[update.effective_user.id % self.connections].append(update)
+
+        async def send_lane(client: httpx.AsyncClient, lane: list) -> None:
+            for update in lane:
+                if await self.post(client, update) != 200:
+                    self.rejected += 1
+
+        limits = httpx.Limits(max_connections=self.connections)
+        async with httpx.AsyncClient(limits=limits, timeout=None) as client:
+            await asyncio.gather(*(send_lane(client, lane) for lane in lanes))
+        return sum(len(lane) for lane in lanes)
+
+    async def check_secret(self, update: Update) -> bool:
+        # Requests without the right secret must be turned away
+        async with httpx.AsyncClient() as client:
+            return await self.post(client, update, secret='wrong') == 403
+
+async def put_updates(application: Application, updates) -> int:
+    sent = 0
+    for update in updates:
+        await application.update_queue.put(update)
+        sent += 1
+    return sent
+
+async def wait_until_idle(application: Application) -> None:
+    queue = application.update_queue
+    while not queue.empty() or queue.in_flight:
+        await asyncio.sleep(0.005)
+
+async def run_phase(application: Application, label: str, updates, sender: WebhookSender = None) -> dict:
+    for histogram in list(main.handler_metrics.values()) + list(main.router.stats.values()):
+        histogram.reset()
+    started = time.perf_counter()
+    sent = await (sender.send(updates) if sender else put_updates(application, updates))
+    await wait_until_idle(application)
+    elapsed = time.perf_counter() - started
+
+    print(f"{label}: {sent} updates in {elapsed:.2f}s ({sent / elapsed:,.0f} updates/s)")
+    for name, histogram in list(main.handler_metrics.items()) + list(main.router.stats.items()):
+        if histogram.count:
+            print(f"  {name:<20} {histogram.count:8} calls  p50 {histogram.percentile(0.5) * 1000:7.2f} ms"
+                  f"  p99 {histogram.percentile(0.99) * 1000:7.2f} ms  {histogram.errors} errors")
+    return {'updates': sent, 'seconds': elapsed, 'p99': main.handler_metrics['button_handler'].percentile(0.99)}
+
+async def run(args) -> int:
+    main.storage.path = os.path.join(args.data_dir, 'loadtest.db')
+    main.storage.open()
+    main.storage.load()
+    main.build_ui_cache()
+
+    api = FakeBotAPI(args.latency / 1000, args.jitter / 1000)
+    update_queue = main.UpdateQueue(args.queue_size)
+    application = (
+        Application.builder()
+        .token('1:loadtest')
+        .request(main.InstrumentedRequest(api))
+        .get_updates_request(FakeBotAPI())
+        .update_queue(update_queue)
+        .concurrent_updates(main.PerUserUpdateProcessor(args.workers, update_queue))
+        .persistence(main.ConversationPersistence())
+        .build()
+    )
+    application.add_handler(CommandHandler("start", main.start))
+    application.add_handler(CallbackQueryHandler(main.button_handler))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, main.handle_message))
+
+    await application.initialize()
+    await main.on_startup(application)
+    await application.start()
+    factory = UpdateFactory(application.bot)
+
+    # Same server and settings as run_webhook in main(), on a local port
+    sender = None
+    failed = False
+    if args.webhook:
+        port = free_port()
+        secret = main.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        await application.updater.start_webhook(
+            listen='127.0.0.1',
+            port=port,
+            url_path=main.WEBHOOK_PATH,
+            webhook_url=f"http://127.0.0.1:{port}/{main.WEBHOOK_PATH}",
+            secret_token=secret,
+            max_connections=args.workers,
+            allowed_updates=main.ALLOWED_UPDATES
+        )
+        sender = WebhookSender(f"http://127.0.0.1:{port}/{main.WEBHOOK_PATH}", secret, args.connections)
+        if not await sender.check_secret(factory.text(1, 'hello')):
+            print("FAIL: webhook accepted an update with the wrong secret")
+            failed = True
+
+    signup = await run_phase(application, "Sign-ups with referrals", signup_updates(factory, args.users, args.fanout),
+                             sender)
+
+    # Give every withdrawing user enough balance to pass the minimum
+    for user_id in range(args.withdraw_every, args.users + 1, args.withdraw_every):
+        async with main.lock_users(user_id):
+            main.post_ledger_entry(user_id, main.MIN_WITHDRAWAL, 'loadtest')
+    activity = await run_phase(application, "Bonus, leaderboard and withdrawals",
+                               activity_updates(factory, args.users, args.withdraw_every), sender)
+
+    if sender:
+        await application.updater.stop()
+        print(f"Webhook: {sender.rejected} updates rejected")
+        if sender.rejected:
+            print(f"FAIL: the webhook server rejected {sender.rejected} updates")
+            failed = True
+    await application.stop()
+    print(f"Bot API calls: {sum(api.calls.values())} {dict(sorted(api.calls.items()))}")
+    print(f"Send queue: sent {main.send_queue.sent}, dropped {main.send_queue.dropped}, waiting {main.send_queue.queue.qsize()}")
+    print(f"Users: {main.count_users()}, pending withdrawals: {len(main.withdrawal_queue)}")
+    await application.shutdown()
+    await main.on_shutdown(application)
+
+    # Fail the run when a budget is given and exceeded, for use in CI
+    throughput = (signup['updates'] + activity['updates']) / (signup['seconds'] + activity['seconds'])
+    if args.min_throughput and throughput < args.min_throughput:
+        print(f"FAIL: throughput {throughput:,.0f} updates/s is below {args.min_throughput:,.0f}")
+        failed = True
+    worst_p99 = max(signup['p99'], activity['p99']) * 1000
+    if args.max_p99_ms and worst_p99 > args.max_p99_ms:
+        print(f"FAIL: button_handler p99 {worst_p99:.1f} ms is above {args.max_p99_ms:.1f} ms")
+        failed = True
+    return 1 if failed else 0
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the bot against a fake Bot API")
+    parser.add_argument('--users', type=int, default=5000, help="synthetic users to simulate")
+    parser.add_argument('--fanout', type=int, default=3, help="referrals per referrer in the referral tree")
+    parser.add_argument('--withdraw-every', type=int, default=10, help="every Nth user requests a withdrawal")
+    parser.add_argument('--latency', type=float, default=20.0, help="fake Bot API latency in ms")
+    parser.add_argument('--jitter', type=float, default=10.0, help="extra random latency in ms")
+    parser.add_argument('--workers', type=int, default=main.UPDATE_WORKERS, help="concurrent updates")
+    parser.add_argument('--queue-size', type=int, default=main.UPDATE_QUEUE_SIZE, help="updates in flight")
+    parser.add_argument('--webhook', action='store_true', help="POST updates to the webhook server instead")
+    parser.add_argument('--connections', type=int, default=main.UPDATE_WORKERS,
+                        help="parallel webhook connections, like Telegram's max_connections")
+    parser.add_argument('--trace-memory', action='store_true', help="measure Python allocations (slows the run)")
+    parser.add_argument('--min-throughput', type=float, default=0, help="fail below this many updates/s")
+    parser.add_argument('--max-p99-ms', type=float, default=0, help="fail above this button_handler p99")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    random.seed(0)
+    if args.trace_memory:
+        gc.collect()
+        tracemalloc.start()
+    with tempfile.TemporaryDirectory() as data_dir:
+        args.data_dir = data_dir
+        status = asyncio.run(run(args))
+    if args.trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"Python memory: {current / 2**20:.1f} MiB retained, {peak / 2**20:.1f} MiB peak "
+              f"({current / args.users:,.0f} B/user retained)")
+    print(f"Max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+    sys.exit(status)
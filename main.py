@@ -1,7 +1,25 @@
+import asyncio
+import bisect
+import csv
+import functools
+import io
+import json
 import logging
+import os
+import re
+import signal
+import sqlite3
+import tempfile
+import time
+from array import array
+from contextlib import asynccontextmanager
+from collections import Counter, OrderedDict, deque, namedtuple
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.error import Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import BaseRequest, HTTPXRequest
+from telegram.ext import Application, BasePersistence, BaseUpdateProcessor, PersistenceInput, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 
 # Configure logging
 logging.basicConfig(
@@ -9,23 +27,40 @@ logging.basicConfig(
     level=logging.INFO
 )
 
-# Dictionary to store user data with additional statistics
-users = {}
+# Per-user record. __slots__ keeps each of the (potentially millions of)
+# records small: timestamps are epoch seconds, referred_by is 0 when the user
+# wasn't referred, and referrals are kept as a count (the referee ids live in
+# the referrals table).
+class UserRecord:
+    __slots__ = ('balance', 'referral_count', 'referred_by', 'join_ts', 'last_active_ts',
+                 'total_earned', 'total_withdrawn')
+
+    def __init__(self, balance=0, referral_count=0, referred_by=0, join_ts=0, last_active_ts=0,
+                 total_earned=0, total_withdrawn=0):
+        self.balance = balance
+        self.referral_count = referral_count
+        self.referred_by = referred_by
+        self.join_ts = join_ts
+        self.last_active_ts = last_active_ts
+        self.total_earned = total_earned
+        self.total_withdrawn = total_withdrawn
+
+def day_number(ts: int) -> int:
+    # Local calendar day of an epoch timestamp, as a date ordinal
+    return datetime.fromtimestamp(ts).toordinal()
 
-# Dictionary to store daily bonus claims
-daily_bonus = {}
+# Dictionary to store user data with additional statistics (user_id -> UserRecord)
+users = {}
 
 # Dictionary to store admin user IDs
 ADMIN_IDS = {123456789}  # Replace with actual admin Telegram IDs
 
-# Dictionary to store withdrawal requests
-withdrawal_requests = {}
 
 # Dictionary to store user statistics
 user_stats = {}
 
-# Dictionary to store valid redeem codes and their amounts
-redeem_codes = {
+# Built-in redeem codes, added to the code inventory on first start
+SEED_REDEEM_CODES = {
     'K76A9FF2RX2CMY69': 10,    # ₹10 reward
     'J5CNBERHRMYJMPV4': 20,    # ₹20 reward
     'ED6F9CHALSAZAZA9': 50,    # ₹50 reward
@@ -34,41 +69,1332 @@ redeem_codes = {
     '00COL9M5KJHE0HE4': 300    # ₹300 reward
 }
 
-# Set to store used redeem codes
-used_codes = set()
-
-# Constants
+# Constants (defaults; any of them can be overridden by the config file or the environment, see below)
+BOT_TOKEN = ''  # Required; set it in the config file or the BOT_TOKEN environment variable
 REFERRAL_BONUS = 10  # ₹10 per referral
 MIN_WITHDRAWAL = 150  # Minimum ₹50 for withdrawal
 DAILY_BONUS_AMOUNT = 25  # ₹15 daily bonus
+DAILY_BONUS_RESET = 'rolling'  # 'rolling' (24 hours after the last claim) or 'calendar' (midnight in DAILY_BONUS_TIMEZONE)
+DAILY_BONUS_TIMEZONE = 'Asia/Kolkata'  # Timezone of the calendar-day reset
+DAILY_BONUS_REMINDERS = True  # Tell users when their next daily bonus can be claimed
 BOT_USERNAME = "earn4cash_bot"  # Bot's username
 CHANNEL_USERNAME = "@usehacktips"  # First channel username
 CHANNEL_USERNAME_2 = "@JRRMODS"  # Second channel username
+WITHDRAWAL_AMOUNTS = [100, 200, 500, 1000]  # UPI withdrawal choices
+REDEEM_AMOUNTS = [10, 20, 50, 100, 200, 300]  # Redeem code denominations
+
+# Runtime configuration. Values come from the defaults above, then the JSON
+# config file, then environment variables of the same name, and are reloaded
+# when the file changes or on SIGHUP.
+CONFIG_PATH = os.environ.get('BOT_CONFIG', 'config.json')  # Optional JSON object of setting -> value
+CONFIG_POLL_INTERVAL = 5  # Seconds between config file change checks
+
+def parse_amount(value) -> int:
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"expected a whole number, got {value!r}")
+    amount = int(value)
+    if amount < 0:
+        raise ValueError(f"must not be negative, got {amount}")
+    return amount
+
+def parse_amount_list(value) -> list:
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, list) or not value:
+        raise ValueError(f"expected a non-empty list of amounts, got {value!r}")
+    amounts = [parse_amount(item) for item in value]
+    if 0 in amounts or len(set(amounts)) != len(amounts):
+        raise ValueError(f"amounts must be positive and distinct, got {amounts}")
+    return amounts
+
+def parse_id_set(value) -> set:
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, list):
+        raise ValueError(f"expected a list of Telegram user ids, got {value!r}")
+    return {parse_amount(item) for item in value}
+
+def parse_pattern(pattern: str, description: str):
+    def parse(value) -> str:
+        if not isinstance(value, str) or not re.fullmatch(pattern, value):
+            raise ValueError(f"expected {description}, got {value!r}")
+        return value
+    return parse
+
+def parse_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ('1', 'true', 'yes', 'on', '0', 'false', 'no', 'off'):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    raise ValueError(f"expected true or false, got {value!r}")
+
+def parse_timezone(value) -> str:
+    try:
+        ZoneInfo(value)
+    except (ZoneInfoNotFoundError, TypeError, ValueError):
+        raise ValueError(f"unknown timezone {value!r}")
+    return value
+
+# Setting -> parser, which validates and normalizes file or environment values
+CONFIG_SCHEMA = {
+    'BOT_TOKEN': parse_pattern(r'\d+:[\w-]+', "a bot token from @BotFather"),
+    'ADMIN_IDS': parse_id_set,
+    'REFERRAL_BONUS': parse_amount,
+    'MIN_WITHDRAWAL': parse_amount,
+    'DAILY_BONUS_AMOUNT': parse_amount,
+    'DAILY_BONUS_RESET': parse_pattern(r'rolling|calendar', "'rolling' or 'calendar'"),
+    'DAILY_BONUS_TIMEZONE': parse_timezone,
+    'DAILY_BONUS_REMINDERS': parse_bool,
+    'BOT_USERNAME': parse_pattern(r'\w{5,32}', "a bot username without @"),
+    'CHANNEL_USERNAME': parse_pattern(r'@\w{5,32}', "a channel username starting with @"),
+    'CHANNEL_USERNAME_2': parse_pattern(r'@\w{5,32}', "a channel username starting with @"),
+    'WITHDRAWAL_AMOUNTS': parse_amount_list,
+    'REDEEM_AMOUNTS': parse_amount_list,
+}
+
+# The application is built with the token once, so a new one needs a restart
+CONFIG_RESTART_REQUIRED = {'BOT_TOKEN'}
+
+# Setting -> new value waiting for a restart, so each change is warned about once
+pending_restart = {}
+
+# Setting -> UI cache entries derived from it, rebuilt when it changes
+CONFIG_UI_DEPENDENTS = {
+    'REFERRAL_BONUS': ('welcome_text', 'how_to_earn_text'),
+    'MIN_WITHDRAWAL': ('how_to_earn_text',),
+    'DAILY_BONUS_AMOUNT': ('how_to_earn_text',),
+    'DAILY_BONUS_RESET': ('how_to_earn_text',),
+    'DAILY_BONUS_TIMEZONE': ('how_to_earn_text',),
+    'CHANNEL_USERNAME': ('join_channel',),
+    'CHANNEL_USERNAME_2': ('join_channel',),
+    'WITHDRAWAL_AMOUNTS': ('withdrawal_amount',),
+    'REDEEM_AMOUNTS': ('redeem_amount',),
+}
+
+CONFIG_DEFAULTS = {name: globals()[name] for name in CONFIG_SCHEMA}
+
+# Modification time of the config file when it was last read
+config_mtime = None
+
+def read_config() -> dict:
+    # Raises ValueError (or OSError) and leaves the running settings alone
+    # when anything is invalid
+    global config_mtime
+    values = dict(CONFIG_DEFAULTS)
+    try:
+        with open(CONFIG_PATH, encoding='utf-8') as file:
+            # Remembered even if the contents turn out invalid, so a bad file
+            # is reported once rather than on every poll
+            config_mtime = os.fstat(file.fileno()).st_mtime_ns
+            overrides = json.load(file)
+    except FileNotFoundError:
+        config_mtime, overrides = None, {}
+    except json.JSONDecodeError as e:
+        raise ValueError(f"{CONFIG_PATH} is not valid JSON: {e}")
+    if not isinstance(overrides, dict):
+        raise ValueError(f"{CONFIG_PATH} must contain a JSON object")
+    unknown = set(overrides) - set(CONFIG_SCHEMA)
+    if unknown:
+        raise ValueError(f"unknown settings in {CONFIG_PATH}: {', '.join(sorted(unknown))}")
+
+    for name, parse in CONFIG_SCHEMA.items():
+        value = os.environ.get(name, overrides.get(name))
+        if value is None:
+            continue
+        try:
+            values[name] = parse(value)
+        except ValueError as e:
+            raise ValueError(f"{name}: {e}")
+    return values
+
+def apply_config(values: dict, startup: bool = False) -> list:
+    # Swaps all changed settings in one synchronous step, so a handler sees
+    # either the old or the new configuration but never a mix
+    global bonus_timezone
+    changed = [name for name, value in values.items() if globals()[name] != value]
+    if not startup:
+        for name in CONFIG_RESTART_REQUIRED:
+            if name not in changed:
+                pending_restart.pop(name, None)
+                continue
+            if pending_restart.get(name) != values[name]:
+                logging.warning(f"{name} changed; restart the bot to apply it")
+                pending_restart[name] = values[name]
+            changed.remove(name)
+    globals().update({name: values[name] for name in changed})
+
+    if 'DAILY_BONUS_TIMEZONE' in changed:
+        bonus_timezone = ZoneInfo(DAILY_BONUS_TIMEZONE)
+    if 'DAILY_BONUS_RESET' in changed or 'DAILY_BONUS_TIMEZONE' in changed:
+        daily_bonus.rebucket()
+    if 'CHANNEL_USERNAME' in changed or 'CHANNEL_USERNAME_2' in changed:
+        membership_cache.clear()
+    ui_names = {ui_name for name in changed for ui_name in CONFIG_UI_DEPENDENTS.get(name, ())}
+    if ui_names:
+        invalidate_ui_cache(*ui_names)
+    return changed
+
+def reload_config(reason: str) -> None:
+    try:
+        values = read_config()
+    except (OSError, ValueError) as e:
+        logging.error(f"Config reload ({reason}) failed, keeping the current settings: {e}")
+        return
+    changed = apply_config(values)
+    if changed:
+        logging.info(f"Config reloaded ({reason}): {', '.join(changed)} changed")
+
+async def watch_config() -> None:
+    while True:
+        await asyncio.sleep(CONFIG_POLL_INTERVAL)
+        try:
+            mtime = os.stat(CONFIG_PATH).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != config_mtime:
+            reload_config('file changed')
+
+# Instrumentation settings
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Histogram bounds in seconds
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))  # Port of the Prometheus text endpoint (0 disables it)
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')  # Address the metrics endpoint binds
+
+# Fixed-bucket latency histogram. Recording is a bisect and two additions, so
+# it is cheap enough to leave on for every update and API call.
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum', 'errors')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, seconds: float, error: bool = False) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if error:
+            self.errors += 1
+
+    def percentile(self, q: float) -> float:
+        # Interpolated within the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= target:
+                if i == len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[-1]
+                lower = LATENCY_BUCKETS[i - 1] if i else 0.0
+                return lower + (LATENCY_BUCKETS[i] - lower) * (target - seen) / n
+            seen += n
+        return LATENCY_BUCKETS[-1]
+
+# Latency histograms by handler name and by Bot API method
+handler_metrics = {}
+api_metrics = {}
+
+# Cache name -> [hits, misses]
+cache_stats = {'membership': [0, 0], 'display_names': [0, 0], 'leaderboard_text': [0, 0], 'ui': [0, 0]}
+
+def get_histogram(registry: dict, name: str) -> Histogram:
+    histogram = registry.get(name)
+    if histogram is None:
+        histogram = registry[name] = Histogram()
+    return histogram
+
+def count_cache(name: str, hit: bool) -> None:
+    cache_stats[name][0 if hit else 1] += 1
+
+def instrument_handler(name: str):
+    # Times a PTB handler callback and counts the calls that raised
+    def decorator(func):
+        histogram = get_histogram(handler_metrics, name)
+
+        @functools.wraps(func)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = await func(update, context)
+                failed = False
+                return result
+            finally:
+                histogram.observe(time.perf_counter() - started, failed)
+        return wrapper
+    return decorator
+
+# Channel membership cache settings
+MEMBERSHIP_CACHE_TTL = 300  # Seconds a positive (joined) result stays valid
+MEMBERSHIP_CACHE_NEGATIVE_TTL = 30  # Seconds a negative (not joined) result stays valid
+MEMBERSHIP_CACHE_MAX_SIZE = 50000  # Max cached (user_id, channel) entries before LRU eviction
+
+# Cache of (user_id, channel) -> (is_member, expires_at), kept in LRU order
+membership_cache = OrderedDict()
+
+# In-flight lookups, so concurrent taps from one user share a single API call
+membership_inflight = {}
 
 # Helper functions
+async def fetch_channel_membership(user_id: int, channel: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    member = await context.bot.get_chat_member(chat_id=channel, user_id=user_id)
+    return member.status in ['member', 'administrator', 'creator']
+
+async def check_single_channel(user_id: int, channel: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    key = (user_id, channel)
+    now = time.monotonic()
+
+    cached = membership_cache.get(key)
+    if cached is not None:
+        is_member, expires_at = cached
+        if expires_at > now:
+            membership_cache.move_to_end(key)
+            count_cache('membership', True)
+            return is_member
+        del membership_cache[key]
+    count_cache('membership', False)
+
+    # Join an identical lookup that is already running
+    pending = membership_inflight.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    task = asyncio.ensure_future(fetch_channel_membership(user_id, channel, context))
+    membership_inflight[key] = task
+    try:
+        is_member = await asyncio.shield(task)
+    finally:
+        membership_inflight.pop(key, None)
+
+    ttl = MEMBERSHIP_CACHE_TTL if is_member else MEMBERSHIP_CACHE_NEGATIVE_TTL
+    membership_cache[key] = (is_member, time.monotonic() + ttl)
+    membership_cache.move_to_end(key)
+    while len(membership_cache) > MEMBERSHIP_CACHE_MAX_SIZE:
+        membership_cache.popitem(last=False)
+    return is_member
+
+def invalidate_membership_cache(user_id: int) -> None:
+    for channel in (CHANNEL_USERNAME, CHANNEL_USERNAME_2):
+        membership_cache.pop((user_id, channel), None)
+
 async def check_channel_membership(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
     try:
-        # Check membership for first channel
-        member1 = await context.bot.get_chat_member(chat_id=CHANNEL_USERNAME, user_id=user_id)
-        is_member1 = member1.status in ['member', 'administrator', 'creator']
-        
-        # Check membership for second channel
-        member2 = await context.bot.get_chat_member(chat_id=CHANNEL_USERNAME_2, user_id=user_id)
-        is_member2 = member2.status in ['member', 'administrator', 'creator']
-        
+        # Check both channels concurrently
+        is_member1, is_member2 = await asyncio.gather(
+            check_single_channel(user_id, CHANNEL_USERNAME, context),
+            check_single_channel(user_id, CHANNEL_USERNAME_2, context)
+        )
         return is_member1 and is_member2
     except Exception as e:
         logging.error(f"Error checking channel membership: {e}")
         return False
 
-def get_join_channel_keyboard():
+# Storage settings
+DATABASE_PATH = "earn4cash.db"  # SQLite database file
+STORAGE_COMMIT_INTERVAL = 0.2  # Seconds to collect writes before a group commit
+STORAGE_BATCH_SIZE = 500  # Pending writes that force an immediate commit
+STORAGE_RETRY_MAX_DELAY = 30.0  # Longest wait between retries of a failed commit
+STORAGE_ALERT_FAILURES = 5  # Consecutive failed commits before logging critical
+
+# SQLite-backed storage. All lookups are served from the in-memory dicts above;
+# every mutation queues a small row-level write which is flushed in one
+# transaction (group commit) shortly after.
+class Storage:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            balance INTEGER NOT NULL,
+            referred_by INTEGER,
+            referral_count INTEGER NOT NULL DEFAULT 0,
+            join_date REAL NOT NULL,
+            total_earned INTEGER NOT NULL,
+            total_withdrawn INTEGER NOT NULL,
+            last_active REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS referrals (
+            referrer_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            created_at REAL,
+            PRIMARY KEY (referrer_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS daily_bonus (
+            user_id INTEGER PRIMARY KEY,
+            last_claim REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS withdrawal_requests (
+            request_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            upi TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            seq INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            resolved_by INTEGER,
+            resolved_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS redeem_codes (
+            code TEXT PRIMARY KEY,
+            amount INTEGER NOT NULL,
+            state INTEGER NOT NULL DEFAULT 0,
+            issued_to INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS ledger (
+            entry_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            delta INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            idempotency_key TEXT UNIQUE,
+            created_at REAL NOT NULL
+        );
+    """
+
+    UPSERT_USER = (
+        "INSERT OR REPLACE INTO users (user_id, balance, referred_by, referral_count, join_date, "
+        "total_earned, total_withdrawn, last_active) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+    )
+    INSERT_REFERRAL = "INSERT OR IGNORE INTO referrals (referrer_id, user_id, created_at) VALUES (?, ?, ?)"
+    UPSERT_DAILY_BONUS = "INSERT OR REPLACE INTO daily_bonus (user_id, last_claim) VALUES (?, ?)"
+    DELETE_DAILY_BONUS = "DELETE FROM daily_bonus WHERE user_id = ?"
+    INSERT_WITHDRAWAL = (
+        "INSERT OR REPLACE INTO withdrawal_requests (request_id, user_id, amount, upi, timestamp, seq) "
+        "VALUES (?, ?, ?, ?, ?, ?)"
+    )
+    RESOLVE_WITHDRAWAL = (
+        "UPDATE withdrawal_requests SET status = ?, resolved_by = ?, resolved_at = ? WHERE request_id = ?"
+    )
+    INSERT_REDEEM_CODE = "INSERT OR IGNORE INTO redeem_codes (code, amount) VALUES (?, ?)"
+    UPDATE_REDEEM_CODE = "UPDATE redeem_codes SET state = ?, issued_to = ? WHERE code = ?"
+    UPSERT_CONVERSATION = (
+        "INSERT OR REPLACE INTO conversations (user_id, state, amount, expires_at) VALUES (?, ?, ?, ?)"
+    )
+    DELETE_CONVERSATION = "DELETE FROM conversations WHERE user_id = ?"
+    INSERT_LEDGER = (
+        "INSERT OR IGNORE INTO ledger (user_id, delta, kind, idempotency_key, created_at) "
+        "VALUES (?, ?, ?, ?, ?)"
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = None
+        self.dirty_users = set()
+        self.pending = []
+        self.flush_handle = None
+        self.failures = 0
+
+    def open(self) -> None:
+        self.conn = sqlite3.connect(self.path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self.migrate()
+
+    def migrate(self) -> None:
+        # Withdrawal requests gained a queue position and a review status
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(withdrawal_requests)")}
+        if 'seq' not in columns:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.execute("ALTER TABLE withdrawal_requests ADD COLUMN seq INTEGER")
+                self.conn.execute("ALTER TABLE withdrawal_requests ADD COLUMN status TEXT NOT NULL DEFAULT 'pending'")
+                self.conn.execute("ALTER TABLE withdrawal_requests ADD COLUMN resolved_by INTEGER")
+                self.conn.execute("ALTER TABLE withdrawal_requests ADD COLUMN resolved_at REAL")
+                self.conn.execute("UPDATE withdrawal_requests SET seq = rowid")
+
+        # Referral counts used to be derived from the referrals table on load
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(users)")}
+        if 'referral_count' not in columns:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.execute("ALTER TABLE users ADD COLUMN referral_count INTEGER NOT NULL DEFAULT 0")
+                self.conn.execute(
+                    "UPDATE users SET referral_count = "
+                    "(SELECT COUNT(*) FROM referrals WHERE referrals.referrer_id = users.user_id)"
+                )
+
+        # Referrals gained a timestamp for the per-hour referral stats
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(referrals)")}
+        if 'created_at' not in columns:
+            self.conn.execute("ALTER TABLE referrals ADD COLUMN created_at REAL")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS referrals_created_at ON referrals (created_at)")
+
+        # Older databases deleted redeemed codes and kept them in used_codes
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(redeem_codes)")}
+        if 'state' not in columns:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.execute("ALTER TABLE redeem_codes ADD COLUMN state INTEGER NOT NULL DEFAULT 0")
+                self.conn.execute("ALTER TABLE redeem_codes ADD COLUMN issued_to INTEGER")
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO redeem_codes (code, amount, state) SELECT code, 0, ? FROM used_codes",
+                    (CODE_REDEEMED,)
+                )
+                self.conn.execute("DROP TABLE used_codes")
+
+    def load(self) -> None:
+        started = time.perf_counter()
+        conn = self.conn
+
+        users.clear()
+        for user_id, balance, referred_by, referral_count, join_date, earned, withdrawn, last_active in conn.execute(
+            "SELECT user_id, balance, referred_by, referral_count, join_date, total_earned, total_withdrawn, "
+            "last_active FROM users"
+        ):
+            users[user_id] = UserRecord(balance, referral_count, referred_by or 0, int(join_date),
+                                        int(last_active), earned, withdrawn)
+
+        # Claims that ran out while the bot was down are dropped, not loaded
+        daily_bonus.clear()
+        now = int(time.time())
+        expired = []
+        for user_id, last_claim in conn.execute("SELECT user_id, last_claim FROM daily_bonus"):
+            if next_bonus_at(int(last_claim)) > now:
+                daily_bonus.set(user_id, int(last_claim))
+            else:
+                expired.append((user_id,))
+        with conn:
+            conn.executemany(self.DELETE_DAILY_BONUS, expired)
+
+        withdrawal_queue.clear()
+        for request_id, seq, user_id, amount, upi, timestamp in conn.execute(
+            "SELECT request_id, seq, user_id, amount, upi, timestamp FROM withdrawal_requests "
+            "WHERE status = 'pending' ORDER BY seq"
+        ):
+            withdrawal_queue.add(WithdrawalRequest(request_id, seq, user_id, amount, upi, int(timestamp)))
+        (max_seq,) = conn.execute("SELECT MAX(seq) FROM withdrawal_requests").fetchone()
+        withdrawal_queue.next_seq = max(withdrawal_queue.next_seq, (max_seq or 0) + 1)
+
+        # Seed the built-in codes once; codes already known keep their state
+        with conn:
+            conn.executemany(self.INSERT_REDEEM_CODE, SEED_REDEEM_CODES.items())
+        redeem_pool.clear()
+        for code, amount, state, issued_to in conn.execute(
+            "SELECT code, amount, state, issued_to FROM redeem_codes ORDER BY rowid"
+        ):
+            redeem_pool.add(code, amount, state, issued_to)
+
+        ledger_keys.clear()
+        for (key,) in reversed(conn.execute(
+            "SELECT idempotency_key FROM ledger WHERE idempotency_key IS NOT NULL ORDER BY entry_id DESC LIMIT ?",
+            (LEDGER_KEY_CACHE_SIZE,)
+        ).fetchall()):
+            ledger_keys[key] = None
+
+        leaderboard_index.rebuild((user_id, user.referral_count) for user_id, user in users.items())
+        referral_graph.rebuild(conn.execute(
+            "SELECT referrer_id, created_at FROM referrals WHERE created_at >= ?",
+            (time.time() - REFERRAL_STATS_HOURS * 3600,)
+        ))
+
+        # Rebuild the running aggregates used by the admin views
+        platform_stats['total_earned'] = sum(user.total_earned for user in users.values())
+        platform_stats['total_withdrawn'] = sum(user.total_withdrawn for user in users.values())
+        activity_buckets.clear()
+        for user in users.values():
+            activity_buckets.add(day_number(user.last_active_ts))
+        activity_buckets.prune(datetime.now().toordinal(), ACTIVE_WINDOW_DAYS)
+
+        logging.info(f"Loaded {len(users)} users from {self.path} in {time.perf_counter() - started:.2f}s")
+
+    def mark_user_dirty(self, user_id: int) -> None:
+        self.dirty_users.add(user_id)
+        self.schedule_flush()
+
+    def write(self, sql: str, params: tuple) -> None:
+        self.pending.append((sql, params))
+        self.schedule_flush()
+
+    def schedule_flush(self) -> None:
+        if self.conn is None:
+            return
+        # While commits are failing, writes wait for the scheduled retry
+        # instead of hitting the database on every call
+        if len(self.pending) + len(self.dirty_users) >= STORAGE_BATCH_SIZE and not self.failures:
+            self.flush()
+            return
+        if self.flush_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush()
+                return
+            self.flush_handle = loop.call_later(STORAGE_COMMIT_INTERVAL, self.flush)
+
+    def flush(self) -> bool:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.conn is None or (not self.pending and not self.dirty_users):
+            return True
+
+        # The batch is only taken off the queue once it has committed
+        pending = self.pending
+        user_rows = []
+        for user_id in self.dirty_users:
+            user = users.get(user_id)
+            if user is not None:
+                user_rows.append((
+                    user_id, user.balance, user.referred_by or None, user.referral_count, user.join_ts,
+                    user.total_earned, user.total_withdrawn, user.last_active_ts
+                ))
+
+        # Only errors that can clear up (locked, busy, I/O) are retried; any
+        # other error comes from a statement that would fail every time
+        try:
+            try:
+                with self.conn:
+                    self.conn.execute("BEGIN")
+                    self.conn.executemany(self.UPSERT_USER, user_rows)
+                    for sql, params in pending:
+                        self.conn.execute(sql, params)
+            except sqlite3.OperationalError:
+                raise
+            except sqlite3.Error as e:
+                logging.error(f"Storage batch failed, committing it one write at a time: {e}")
+                self.commit_each([(self.UPSERT_USER, row) for row in user_rows] + pending)
+        except sqlite3.Error as e:
+            self.retry_later(len(user_rows) + len(pending), e)
+            return False
+
+        self.dirty_users = set()
+        self.pending = []
+        if self.failures:
+            logging.warning(f"Storage commits recovered after {self.failures} failed attempts")
+            self.failures = 0
+        return True
+
+    def commit_each(self, statements: list) -> None:
+        # Drops the writes that fail on their own and commits the rest
+        with self.conn:
+            self.conn.execute("BEGIN")
+            for sql, params in statements:
+                try:
+                    self.conn.execute(sql, params)
+                except sqlite3.OperationalError:
+                    raise
+                except sqlite3.Error as e:
+                    logging.error(f"Dropping storage write {sql.split('(')[0].strip()} {params}: {e}")
+
+    def retry_later(self, writes: int, error: Exception) -> None:
+        # The batch stays queued and is retried with exponential backoff
+        self.failures += 1
+        delay = min(STORAGE_COMMIT_INTERVAL * 2 ** self.failures, STORAGE_RETRY_MAX_DELAY)
+        log = logging.critical if self.failures >= STORAGE_ALERT_FAILURES else logging.error
+        log(f"Failed to commit {writes} storage writes (attempt {self.failures}), retrying in {delay:.1f}s: {error}")
+        try:
+            self.flush_handle = asyncio.get_running_loop().call_later(delay, self.flush)
+        except RuntimeError:
+            pass
+
+    def iter_user_ids(self, batch_size: int = 1000):
+        # Walks the users table in primary key order, one batch at a time
+        self.flush()
+        last_id = None
+        while True:
+            if last_id is None:
+                rows = self.conn.execute("SELECT user_id FROM users ORDER BY user_id LIMIT ?", (batch_size,)).fetchall()
+            else:
+                rows = self.conn.execute(
+                    "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (last_id, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for (user_id,) in rows:
+                yield user_id
+            last_id = rows[-1][0]
+
+    def load_conversation_ids(self) -> set:
+        # Only the ids: each state is read on the user's next update
+        with self.conn:
+            self.conn.execute("DELETE FROM conversations WHERE expires_at <= ?", (time.time(),))
+        return {user_id for (user_id,) in self.conn.execute("SELECT user_id FROM conversations")}
+
+    def read_conversation(self, user_id: int):
+        row = self.conn.execute(
+            "SELECT state, amount, expires_at FROM conversations WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return (row[0], row[1], int(row[2])) if row is not None else None
+
+    def close(self) -> None:
+        if not self.flush():
+            logging.critical(f"Closing storage with {len(self.pending) + len(self.dirty_users)} uncommitted writes")
+            if self.flush_handle is not None:
+                self.flush_handle.cancel()
+                self.flush_handle = None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+storage = Storage(DATABASE_PATH)
+
+LEADERBOARD_SIZE = 10  # Users shown on the leaderboard
+
+# Referral leaderboard kept up to date as referrals are credited. Users are
+# grouped into buckets by referral count; a Fenwick tree over the counts gives
+# rank lookups and the sorted list of non-empty counts gives the top entries
+# without scanning every user.
+class LeaderboardIndex:
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.counts = {}
+        self.buckets = {}
+        self.levels = []
+        self.tree = [0] * 64
+        self.version = 0
+
+    def tree_add(self, count: int, delta: int) -> None:
+        i = count + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def tree_prefix(self, count: int) -> int:
+        # Number of users with at most `count` referrals
+        total = 0
+        i = min(count + 1, len(self.tree) - 1)
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def grow(self, count: int) -> None:
+        size = len(self.tree)
+        while count + 1 >= size:
+            size *= 2
+        self.tree = [0] * size
+        for level, bucket in self.buckets.items():
+            self.tree_add(level, len(bucket))
+
+    def place(self, user_id: int, count: int) -> None:
+        if count + 1 >= len(self.tree):
+            self.grow(count)
+        bucket = self.buckets.get(count)
+        if bucket is None:
+            bucket = self.buckets[count] = {}
+            bisect.insort(self.levels, count)
+        bucket[user_id] = None
+        self.counts[user_id] = count
+        self.tree_add(count, 1)
+
+    def remove(self, user_id: int) -> int:
+        count = self.counts.pop(user_id)
+        bucket = self.buckets[count]
+        del bucket[user_id]
+        if not bucket:
+            del self.buckets[count]
+            del self.levels[bisect.bisect_left(self.levels, count)]
+        self.tree_add(count, -1)
+        return count
+
+    def add_user(self, user_id: int, count: int = 0) -> None:
+        if user_id in self.counts:
+            return
+        self.place(user_id, count)
+        if self.rank(user_id) <= LEADERBOARD_SIZE:
+            self.version += 1
+
+    def increment(self, user_id: int) -> None:
+        count = self.remove(user_id) if user_id in self.counts else 0
+        self.place(user_id, count + 1)
+        if self.rank(user_id) <= LEADERBOARD_SIZE:
+            self.version += 1
+
+    def rebuild(self, referral_counts) -> None:
+        self.clear()
+        for user_id, count in referral_counts:
+            self.place(user_id, count)
+
+    def rank(self, user_id: int):
+        count = self.counts.get(user_id)
+        if count is None:
+            return None
+        return len(self.counts) - self.tree_prefix(count) + 1
+
+    def top(self, k: int) -> list:
+        result = []
+        for level in reversed(self.levels):
+            for user_id in self.buckets[level]:
+                result.append((user_id, level))
+                if len(result) == k:
+                    return result
+        return result
+
+leaderboard_index = LeaderboardIndex()
+
+REFERRAL_STATS_HOURS = 7 * 24  # Hours of per-referrer referral counts kept for the admin views
+REFERRAL_BURST_THRESHOLD = 30  # Referrals to one referrer within a clock hour that flag a burst
+REFERRAL_TOP_SIZE = 10  # Referrers listed by /topreferrers
+
+# Referral graph. Each user's referrer is UserRecord.referred_by; this keeps
+# the other direction, the size of every user's whole downline (updated along
+# the ancestor path on each referral) and per-referrer referral counts in
+# hourly buckets, so the admin queries never scan all users.
+class ReferralGraph:
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.children = {}  # referrer_id -> array of direct referrals
+        self.downline = {}  # user_id -> users below them at any level (absent means 0)
+        self.hours = {}  # hour number -> Counter of referrer_id -> referrals
+        self.flagged = {}  # referrer_id -> hour number of their latest burst
+
+    def ancestors(self, user_id: int):
+        # The seen set stops the walk on cycles left in older databases
+        seen = set()
+        user = users.get(user_id)
+        while user is not None and user.referred_by and user.referred_by not in seen:
+            seen.add(user.referred_by)
+            yield user.referred_by
+            user = users.get(user.referred_by)
+
+    def would_cycle(self, referrer_id: int, user_id: int) -> bool:
+        # Only a user who already has referrals can be above their new referrer
+        if user_id not in self.children:
+            return False
+        return any(ancestor == user_id for ancestor in self.ancestors(referrer_id))
+
+    def add(self, referrer_id: int, user_id: int, timestamp: int) -> bool:
+        # Called after referred_by is set; returns True when this referral
+        # starts a burst for the referrer
+        self.children.setdefault(referrer_id, array('q')).append(user_id)
+        size = 1 + self.downline.get(user_id, 0)
+        self.downline[referrer_id] = self.downline.get(referrer_id, 0) + size
+        for ancestor in self.ancestors(referrer_id):
+            self.downline[ancestor] = self.downline.get(ancestor, 0) + size
+        return self.count(referrer_id, timestamp)
+
+    def count(self, referrer_id: int, timestamp: int) -> bool:
+        hour = timestamp // 3600
+        counts = self.hours.get(hour)
+        if counts is None:
+            counts = self.hours[hour] = Counter()
+            self.prune(hour)
+        counts[referrer_id] += 1
+        if counts[referrer_id] == REFERRAL_BURST_THRESHOLD:
+            self.flagged[referrer_id] = hour
+            return True
+        return False
+
+    def prune(self, hour: int) -> None:
+        oldest = hour - REFERRAL_STATS_HOURS
+        for key in [key for key in self.hours if key <= oldest]:
+            del self.hours[key]
+        for referrer_id in [r for r, flagged_hour in self.flagged.items() if flagged_hour <= oldest]:
+            del self.flagged[referrer_id]
+
+    def recent(self, referrer_id: int, hours: int, now: int) -> int:
+        current = now // 3600
+        return sum(counts.get(referrer_id, 0) for hour, counts in self.hours.items() if hour > current - hours)
+
+    def top(self, hours: int, now: int, k: int = REFERRAL_TOP_SIZE) -> list:
+        # Only touches referrers active in the window
+        current = now // 3600
+        totals = Counter()
+        for hour, counts in self.hours.items():
+            if hour > current - hours:
+                totals.update(counts)
+        return totals.most_common(k)
+
+    def second_level(self, user_id: int) -> int:
+        return sum(len(self.children.get(child, ())) for child in self.children.get(user_id, ()))
+
+    def depth(self, user_id: int) -> int:
+        return sum(1 for _ in self.ancestors(user_id))
+
+    def rebuild(self, recent_referrals) -> None:
+        self.clear()
+        for user_id, user in users.items():
+            if user.referred_by:
+                self.children.setdefault(user.referred_by, array('q')).append(user_id)
+
+        # Downline sizes bottom-up: a user is folded into their referrer once
+        # all of their own referrals have been. Users on a cycle are never
+        # reached and keep partial sizes.
+        pending = {referrer_id: len(children) for referrer_id, children in self.children.items()}
+        stack = [user_id for user_id, user in users.items() if user.referred_by and user_id not in pending]
+        while stack:
+            user_id = stack.pop()
+            referrer_id = users[user_id].referred_by
+            self.downline[referrer_id] = self.downline.get(referrer_id, 0) + 1 + self.downline.get(user_id, 0)
+            pending[referrer_id] -= 1
+            if pending[referrer_id] == 0 and referrer_id in users and users[referrer_id].referred_by:
+                stack.append(referrer_id)
+        on_cycles = sum(1 for left in pending.values() if left)
+        if on_cycles:
+            logging.warning(f"{on_cycles} referrers are on or above referral cycles; their downline sizes are partial")
+
+        for referrer_id, created_at in recent_referrals:
+            self.count(referrer_id, int(created_at))
+
+referral_graph = ReferralGraph()
+
+LOW_STOCK_THRESHOLD = 5  # Warn admins when a denomination has fewer codes left
+CODE_IMPORT_MAX_BYTES = 5 * 1024 * 1024  # Largest code file accepted for bulk import
+
+# Redeem code lifecycle states
+CODE_AVAILABLE = 0
+CODE_ISSUED = 1
+CODE_REDEEMED = 2
+
+# Redeem code inventory. Available codes wait in a FIFO queue per denomination
+# so issuing one is O(1); every known code maps to a single packed int
+# (amount << 2 | state), which also serves as the index of redeemed codes.
+class RedeemCodePool:
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.queues = {}
+        self.codes = {}
+        self.issued_to = {}
+        self.counts = [0, 0, 0]
+        self.available_counts = {}
+
+    def state(self, code: str):
+        packed = self.codes.get(code)
+        return None if packed is None else packed & 3
+
+    def amount(self, code: str):
+        packed = self.codes.get(code)
+        return None if packed is None else packed >> 2
+
+    def set_state(self, code: str, amount: int, state: int) -> None:
+        previous = self.codes.get(code)
+        if previous is not None:
+            self.counts[previous & 3] -= 1
+            if previous & 3 == CODE_AVAILABLE:
+                self.available_counts[amount] -= 1
+        self.codes[code] = amount << 2 | state
+        self.counts[state] += 1
+        if state == CODE_AVAILABLE:
+            self.available_counts[amount] = self.available_counts.get(amount, 0) + 1
+
+    def add(self, code: str, amount: int, state: int = CODE_AVAILABLE, issued_to=None) -> bool:
+        if code in self.codes:
+            return False
+        self.set_state(code, amount, state)
+        if state == CODE_AVAILABLE:
+            self.queues.setdefault(amount, deque()).append(code)
+        elif state == CODE_ISSUED:
+            self.issued_to[code] = issued_to
+        return True
+
+    def issue(self, amount: int, user_id: int):
+        queue = self.queues.get(amount)
+        while queue:
+            code = queue.popleft()
+            if self.state(code) == CODE_AVAILABLE:
+                self.set_state(code, amount, CODE_ISSUED)
+                self.issued_to[code] = user_id
+                return code
+        return None
+
+    def redeem(self, code: str, user_id: int):
+        # Returns (state before redeeming, amount); only a code issued to this
+        # user can be redeemed, so stock codes can't skip being paid for
+        packed = self.codes.get(code)
+        if packed is None:
+            return None, None
+        amount, state = packed >> 2, packed & 3
+        if state != CODE_ISSUED or self.issued_to.get(code) != user_id:
+            return state, None
+        self.set_state(code, amount, CODE_REDEEMED)
+        self.issued_to.pop(code, None)
+        return state, amount
+
+    def stock(self) -> dict:
+        return {amount: count for amount, count in sorted(self.available_counts.items())}
+
+redeem_pool = RedeemCodePool()
+
+ACTIVE_WINDOW_DAYS = 7  # Window for the admin "active users" count
+
+# Platform totals, updated alongside every user balance change
+platform_stats = {'total_earned': 0, 'total_withdrawn': 0}
+
+# Number of users per last-active day (date ordinal). A user moves between
+# buckets when they become active on a new day, so counting active users only
+# touches one bucket per day in the window.
+class ActivityBuckets:
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.buckets = {}
+
+    def add(self, day: int) -> None:
+        self.buckets[day] = self.buckets.get(day, 0) + 1
+
+    def move(self, old_day: int, new_day: int) -> None:
+        if old_day == new_day:
+            return
+        # Days that were already pruned have no bucket to decrement
+        if old_day in self.buckets:
+            self.buckets[old_day] -= 1
+            if not self.buckets[old_day]:
+                del self.buckets[old_day]
+        self.add(new_day)
+
+    def count(self, today: int, days: int) -> int:
+        return sum(self.buckets.get(day, 0) for day in range(today - days + 1, today + 1))
+
+    def prune(self, today: int, days: int) -> None:
+        for day in [day for day in self.buckets if day <= today - days]:
+            del self.buckets[day]
+
+activity_buckets = ActivityBuckets()
+
+BONUS_BUCKET_SECONDS = 3600  # Claims becoming claimable again within the same hour share a sweep bucket
+
+bonus_timezone = ZoneInfo(DAILY_BONUS_TIMEZONE)
+
+def next_bonus_at(claim_ts: int) -> int:
+    # Epoch second from which the bonus can be claimed again
+    if DAILY_BONUS_RESET == 'calendar':
+        claim_day = datetime.fromtimestamp(claim_ts, bonus_timezone).date()
+        midnight = datetime.combine(claim_day + timedelta(days=1), datetime.min.time(), bonus_timezone)
+        return int(midnight.timestamp())
+    return claim_ts + 86400
+
+# Daily bonus claims that are still running (user_id -> claim epoch seconds),
+# indexed by the hour bucket in which they run out. Only these carry any
+# information: a user without an entry can claim, so the periodic sweep drops
+# whole buckets once they are due instead of keeping every claim forever.
+class DailyBonusClaims:
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.claims = {}
+        self.buckets = {}
+
+    def __len__(self) -> int:
+        return len(self.claims)
+
+    def bucket(self, claim_ts: int) -> int:
+        # Rounded up, so a bucket is never due before all of its claims are
+        return -(-next_bonus_at(claim_ts) // BONUS_BUCKET_SECONDS)
+
+    def get(self, user_id: int):
+        return self.claims.get(user_id)
+
+    def set(self, user_id: int, claim_ts: int) -> None:
+        previous = self.claims.get(user_id)
+        if previous is not None:
+            bucket = self.buckets.get(self.bucket(previous))
+            if bucket is not None:
+                bucket.discard(user_id)
+        self.claims[user_id] = claim_ts
+        self.buckets.setdefault(self.bucket(claim_ts), set()).add(user_id)
+
+    def pop_due(self, now: int) -> list:
+        # Users whose bonus can be claimed again, removed from the index
+        current = now // BONUS_BUCKET_SECONDS
+        due = []
+        for key in [key for key in self.buckets if key <= current]:
+            for user_id in self.buckets.pop(key):
+                del self.claims[user_id]
+                due.append(user_id)
+        return due
+
+    def rebucket(self) -> None:
+        # After the reset policy changed, every claim's bucket may have moved
+        self.buckets = {}
+        for user_id, claim_ts in self.claims.items():
+            self.buckets.setdefault(self.bucket(claim_ts), set()).add(user_id)
+
+daily_bonus = DailyBonusClaims()
+
+WITHDRAWALS_PAGE_SIZE = 5  # Pending withdrawals shown per admin page
+WITHDRAWAL_EXPORT_CHUNK = 1000  # Rows written per chunk in the CSV export
+
+class WithdrawalRequest:
+    __slots__ = ('request_id', 'seq', 'user_id', 'amount', 'upi', 'timestamp')
+
+    def __init__(self, request_id, seq, user_id, amount, upi, timestamp):
+        self.request_id = request_id
+        self.seq = seq
+        self.user_id = user_id
+        self.amount = amount
+        self.upi = upi
+        self.timestamp = timestamp
+
+# Pending withdrawal requests in arrival order. Each request gets an increasing
+# sequence number, which doubles as the pagination cursor: a page is a bisect
+# into the sorted list of pending sequence numbers plus a slice.
+class WithdrawalQueue:
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        self.pending = {}
+        self.seqs = []
+        self.next_seq = 1
+
+    def __len__(self) -> int:
+        return len(self.seqs)
+
+    def add(self, request: WithdrawalRequest) -> None:
+        self.pending[request.seq] = request
+        bisect.insort(self.seqs, request.seq)
+        self.next_seq = max(self.next_seq, request.seq + 1)
+
+    def get(self, seq: int):
+        return self.pending.get(seq)
+
+    def remove(self, seq: int):
+        request = self.pending.pop(seq, None)
+        if request is not None:
+            del self.seqs[bisect.bisect_left(self.seqs, seq)]
+        return request
+
+    def page(self, after_seq: int = 0, size: int = WITHDRAWALS_PAGE_SIZE) -> list:
+        start = bisect.bisect_right(self.seqs, after_seq)
+        return [self.pending[seq] for seq in self.seqs[start:start + size]]
+
+    def has_more(self, after_seq: int) -> bool:
+        return bisect.bisect_right(self.seqs, after_seq) < len(self.seqs)
+
+    def position(self, seq: int) -> int:
+        # 1-based position of a request in the queue
+        return bisect.bisect_left(self.seqs, seq) + 1
+
+withdrawal_queue = WithdrawalQueue()
+
+# Display name cache for the leaderboard
+NAME_CACHE_MAX_SIZE = 100000  # Max cached display names before LRU eviction
+LEADERBOARD_FETCH_CONCURRENCY = 5  # Max parallel get_chat calls for uncached names
+
+# user_id -> first name, filled from incoming updates and kept in LRU order
+display_names = OrderedDict()
+display_names_version = 0
+
+leaderboard_fetch_semaphore = asyncio.Semaphore(LEADERBOARD_FETCH_CONCURRENCY)
+
+# Rendered top list, reused until the ranking or a shown name changes
+leaderboard_text_cache = {'key': None, 'text': None}
+
+def remember_display_name(user_id: int, name: str) -> None:
+    global display_names_version
+    previous = display_names.get(user_id)
+    display_names[user_id] = name
+    display_names.move_to_end(user_id)
+    if previous != name:
+        rank = leaderboard_index.rank(user_id)
+        if rank is not None and rank <= LEADERBOARD_SIZE:
+            display_names_version += 1
+    while len(display_names) > NAME_CACHE_MAX_SIZE:
+        display_names.popitem(last=False)
+
+async def fetch_display_name(user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    async with leaderboard_fetch_semaphore:
+        try:
+            chat = await context.bot.get_chat(user_id)
+        except Exception:
+            return None
+    remember_display_name(user_id, chat.first_name)
+    return chat.first_name
+
+# Balance ledger settings
+LOCK_STRIPES = 1024  # Number of asyncio locks shared by all users
+LEDGER_KEY_CACHE_SIZE = 100000  # Recent idempotency keys kept in memory
+
+# Striped per-user locks: a user always maps to the same lock, and memory stays
+# bounded no matter how many users there are
+user_locks = [asyncio.Lock() for _ in range(LOCK_STRIPES)]
+
+# Recently applied idempotency keys, in LRU order
+ledger_keys = OrderedDict()
+
+class InsufficientBalance(Exception):
+    pass
+
+@asynccontextmanager
+async def lock_users(*user_ids):
+    # Stripes are always taken in ascending order so two tasks locking the
+    # same pair of users can't deadlock
+    stripes = sorted({user_id % LOCK_STRIPES for user_id in user_ids})
+    acquired = []
+    try:
+        for stripe in stripes:
+            await user_locks[stripe].acquire()
+            acquired.append(stripe)
+        yield
+    finally:
+        for stripe in reversed(acquired):
+            user_locks[stripe].release()
+
+def remember_ledger_key(key: str) -> None:
+    ledger_keys[key] = None
+    ledger_keys.move_to_end(key)
+    while len(ledger_keys) > LEDGER_KEY_CACHE_SIZE:
+        ledger_keys.popitem(last=False)
+
+def post_ledger_entry(user_id: int, delta: int, kind: str, idempotency_key: str = None,
+                      earned: int = 0, withdrawn: int = 0, touch: bool = False) -> bool:
+    # Applies one balance change and appends it to the ledger. The caller must
+    # hold lock_users(user_id). Returns False if the key was already applied.
+    if idempotency_key is not None and idempotency_key in ledger_keys:
+        return False
+    user = users[user_id]
+    if user.balance + delta < 0:
+        raise InsufficientBalance(f"User {user_id} has ₹{user.balance}, needs ₹{-delta}")
+    update_user(user_id, balance=delta, total_earned=earned, total_withdrawn=withdrawn, touch=touch)
+    storage.write(Storage.INSERT_LEDGER, (user_id, delta, kind, idempotency_key, time.time()))
+    if idempotency_key is not None:
+        remember_ledger_key(idempotency_key)
+    return True
+
+def update_key(update: Update, kind: str) -> str:
+    return f"{update.update_id}:{kind}"
+
+# Repository functions used by the handlers
+def get_user(user_id: int):
+    return users.get(user_id)
+
+def create_user(user_id: int) -> UserRecord:
+    now = int(time.time())
+    users[user_id] = UserRecord(join_ts=now, last_active_ts=now)
+    storage.mark_user_dirty(user_id)
+    leaderboard_index.add_user(user_id)
+    activity_buckets.add(day_number(now))
+    return users[user_id]
+
+def update_user(user_id: int, balance: int = 0, total_earned: int = 0, total_withdrawn: int = 0, touch: bool = True) -> UserRecord:
+    user = users[user_id]
+    user.balance += balance
+    user.total_earned += total_earned
+    user.total_withdrawn += total_withdrawn
+    platform_stats['total_earned'] += total_earned
+    platform_stats['total_withdrawn'] += total_withdrawn
+    if touch:
+        now = int(time.time())
+        activity_buckets.move(day_number(user.last_active_ts), day_number(now))
+        user.last_active_ts = now
+    storage.mark_user_dirty(user_id)
+    return user
+
+def can_refer(referrer_id: int, user_id: int) -> bool:
+    # A user can only ever be referred once, so referred_by doubles as the
+    # duplicate check; referring someone from your own downline is refused
+    referrer = get_user(referrer_id)
+    return (referrer_id != user_id and referrer is not None and not get_user(user_id).referred_by
+            and not referral_graph.would_cycle(referrer_id, user_id))
+
+def add_referral(referrer_id: int, user_id: int) -> bool:
+    # Returns True when the referral flags a burst for the referrer
+    now = int(time.time())
+    users[referrer_id].referral_count += 1
+    users[user_id].referred_by = referrer_id
+    storage.mark_user_dirty(referrer_id)
+    storage.mark_user_dirty(user_id)
+    storage.write(Storage.INSERT_REFERRAL, (referrer_id, user_id, now))
+    leaderboard_index.increment(referrer_id)
+    return referral_graph.add(referrer_id, user_id, now)
+
+def get_daily_bonus_claim(user_id: int):
+    return daily_bonus.get(user_id)
+
+def set_daily_bonus_claim(user_id: int, claimed_at: int) -> None:
+    daily_bonus.set(user_id, claimed_at)
+    storage.write(Storage.UPSERT_DAILY_BONUS, (user_id, claimed_at))
+
+def get_next_bonus_time(user_id: int) -> int:
+    # 0 when the bonus can be claimed right away
+    claimed_at = daily_bonus.get(user_id)
+    return next_bonus_at(claimed_at) if claimed_at is not None else 0
+
+def expire_daily_bonus_claims(now: int) -> list:
+    due = daily_bonus.pop_due(now)
+    for user_id in due:
+        storage.write(Storage.DELETE_DAILY_BONUS, (user_id,))
+    return due
+
+def add_withdrawal_request(user_id: int, amount: int, upi: str) -> WithdrawalRequest:
+    now = datetime.now()
+    seq = withdrawal_queue.next_seq
+    request_id = f"{user_id}_{now.strftime('%Y%m%d%H%M%S')}_{seq}"
+    request = WithdrawalRequest(request_id, seq, user_id, amount, upi, int(now.timestamp()))
+    withdrawal_queue.add(request)
+    storage.write(Storage.INSERT_WITHDRAWAL, (request_id, user_id, amount, upi, request.timestamp, seq))
+    return request
+
+def resolve_withdrawal_request(seq: int, status: str, admin_id: int):
+    # Takes a request out of the pending queue; None if it was already handled
+    request = withdrawal_queue.remove(seq)
+    if request is not None:
+        storage.write(Storage.RESOLVE_WITHDRAWAL, (status, admin_id, time.time(), request.request_id))
+    return request
+
+def iter_user_ids():
+    return storage.iter_user_ids()
+
+def count_users() -> int:
+    return len(users)
+
+def count_active_users() -> int:
+    today = datetime.now().toordinal()
+    activity_buckets.prune(today, ACTIVE_WINDOW_DAYS)
+    return activity_buckets.count(today, ACTIVE_WINDOW_DAYS)
+
+def get_platform_stats() -> dict:
+    return platform_stats
+
+def count_redeem_codes() -> int:
+    return redeem_pool.counts[CODE_AVAILABLE]
+
+def count_used_codes() -> int:
+    return redeem_pool.counts[CODE_REDEEMED]
+
+def issue_redeem_code(amount: int, user_id: int):
+    code = redeem_pool.issue(amount, user_id)
+    if code is not None:
+        storage.write(Storage.UPDATE_REDEEM_CODE, (CODE_ISSUED, user_id, code))
+        remaining = redeem_pool.available_counts.get(amount, 0)
+        if remaining < LOW_STOCK_THRESHOLD:
+            logging.warning(f"Low stock for ₹{amount} redeem codes: {remaining} left")
+    return code
+
+def use_redeem_code(code: str, user_id: int):
+    state, amount = redeem_pool.redeem(code, user_id)
+    if amount is not None:
+        storage.write(Storage.UPDATE_REDEEM_CODE, (CODE_REDEEMED, user_id, code))
+    return state, amount
+
+def import_redeem_codes(rows) -> tuple:
+    # Adds (code, amount) pairs, returning (added, duplicates)
+    added = duplicates = 0
+    for code, amount in rows:
+        if redeem_pool.add(code, amount):
+            storage.write(Storage.INSERT_REDEEM_CODE, (code, amount))
+            added += 1
+        else:
+            duplicates += 1
+    return added, duplicates
+
+# Builders for the inline keyboards. Handlers use the get_* functions below,
+# which serve shared instances from the UI cache instead of rebuilding.
+def build_join_channel_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📢 Join Channel 1", url=f"https://t.me/{CHANNEL_USERNAME.replace('@', '')}")],
         [InlineKeyboardButton("📢 Join Channel 2", url=f"https://t.me/{CHANNEL_USERNAME_2.replace('@', '')}")],
         [InlineKeyboardButton("✅ Check Membership", callback_data='check_membership')]
     ])
 
-def get_main_menu_keyboard(is_admin=False):
+def build_main_menu_keyboard(is_admin=False):
     keyboard = [
         [InlineKeyboardButton("💰 Balance", callback_data='check_balance'),
          InlineKeyboardButton("🔗 Referral Link", callback_data='get_referral')],
@@ -82,49 +1408,526 @@ def get_main_menu_keyboard(is_admin=False):
         keyboard.append([InlineKeyboardButton("👑 Admin Panel", callback_data='admin_panel')])
     return InlineKeyboardMarkup(keyboard)
 
-def get_back_button():
+def build_back_button():
     return InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Menu", callback_data='back_to_menu')]])
 
-def get_join_channel_keyboard():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📢 Join Channel", url=f"https://t.me/{CHANNEL_USERNAME.replace('@', '')}")],
-        [InlineKeyboardButton("✅ Check Membership", callback_data='check_membership')]
-    ])
+def build_bonus_ready_keyboard():
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🎁 Claim Daily Bonus", callback_data='daily_bonus')]])
 
-def get_withdrawal_options_keyboard():
+def build_withdrawal_options_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("💳 UPI Payment", callback_data='withdraw_upi')],
         [InlineKeyboardButton("🎫 Redeem Code", callback_data='withdraw_redeem')],
         [InlineKeyboardButton("🔙 Back to Menu", callback_data='back_to_menu')]
     ])
 
-def get_withdrawal_amount_keyboard():
-    amounts = [100, 200, 500, 1000]
-    keyboard = []
-    for i in range(0, len(amounts), 2):
-        row = []
-        row.append(InlineKeyboardButton(f"₹{amounts[i]}", callback_data=f'amount_{amounts[i]}'))
-        if i + 1 < len(amounts):
-            row.append(InlineKeyboardButton(f"₹{amounts[i+1]}", callback_data=f'amount_{amounts[i+1]}'))
-        keyboard.append(row)
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='withdraw')])
-    return InlineKeyboardMarkup(keyboard)
+def build_amount_keyboard(amounts, prefix):
+    keyboard = []
+    for i in range(0, len(amounts), 2):
+        row = []
+        row.append(InlineKeyboardButton(f"₹{amounts[i]}", callback_data=f'{prefix}{amounts[i]}'))
+        if i + 1 < len(amounts):
+            row.append(InlineKeyboardButton(f"₹{amounts[i+1]}", callback_data=f'{prefix}{amounts[i+1]}'))
+        keyboard.append(row)
+    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='withdraw')])
+    return InlineKeyboardMarkup(keyboard)
+
+def build_withdrawal_amount_keyboard():
+    return build_amount_keyboard(WITHDRAWAL_AMOUNTS, 'amount_')
+
+def build_redeem_amount_keyboard():
+    return build_amount_keyboard(REDEEM_AMOUNTS, 'redeem_')
+
+def build_admin_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📝 Pending Withdrawals", callback_data='admin_withdrawals'),
+         InlineKeyboardButton("👥 User List", callback_data='admin_users')],
+        [InlineKeyboardButton("🎫 Manage Codes", callback_data='admin_codes'),
+         InlineKeyboardButton("📊 Statistics", callback_data='admin_stats')],
+        [InlineKeyboardButton("📈 Perf", callback_data='admin_perf'),
+         InlineKeyboardButton("🔙 Back to Menu", callback_data='back_to_menu')]
+    ])
+
+# Static message texts that only depend on constants
+def build_welcome_text():
+    return (
+        f"I'm your Referral Earning Bot. Earn ₹{REFERRAL_BONUS} for each successful referral!\n\n"
+        "Use the buttons below to:\n"
+        "- Check your balance 💰\n"
+        "- Get your referral link 🔗\n"
+        "- Withdraw your earnings 💸\n"
+        "- Claim daily bonus 🎁\n"
+        "- Learn how to earn more ℹ️"
+    )
+
+def build_how_to_earn_text():
+    if DAILY_BONUS_RESET == 'calendar':
+        bonus_schedule = f"once a day (resets at midnight {DAILY_BONUS_TIMEZONE} time)"
+    else:
+        bonus_schedule = "every 24 hours"
+    return (
+        "💡 How to Earn:\n\n"
+        f"1. Refer Friends: ₹{REFERRAL_BONUS} per referral\n"
+        f"2. Daily Bonus: ₹{DAILY_BONUS_AMOUNT} {bonus_schedule}\n\n"
+        f"Minimum withdrawal: ₹{MIN_WITHDRAWAL}"
+    )
+
+# Registry of (name, variant) -> builder. Every entry is built once by
+# build_ui_cache() and the same immutable object is handed out afterwards.
+UI_BUILDERS = {
+    ('join_channel', None): build_join_channel_keyboard,
+    ('main_menu', False): lambda: build_main_menu_keyboard(is_admin=False),
+    ('main_menu', True): lambda: build_main_menu_keyboard(is_admin=True),
+    ('back', None): build_back_button,
+    ('bonus_ready', None): build_bonus_ready_keyboard,
+    ('withdrawal_options', None): build_withdrawal_options_keyboard,
+    ('withdrawal_amount', None): build_withdrawal_amount_keyboard,
+    ('redeem_amount', None): build_redeem_amount_keyboard,
+    ('admin', None): build_admin_keyboard,
+    ('welcome_text', None): build_welcome_text,
+    ('how_to_earn_text', None): build_how_to_earn_text,
+}
+
+ui_cache = {}
+
+def build_ui_cache() -> None:
+    ui_cache.clear()
+    for key, builder in UI_BUILDERS.items():
+        ui_cache[key] = builder()
+
+def invalidate_ui_cache(*names) -> None:
+    # Rebuild the given entries (all of them when no names are passed),
+    # e.g. after the constants they are derived from have changed
+    for key, builder in UI_BUILDERS.items():
+        if not names or key[0] in names:
+            ui_cache[key] = builder()
+
+def get_ui(name: str, variant=None):
+    key = (name, variant)
+    value = ui_cache.get(key)
+    count_cache('ui', value is not None)
+    if value is None:
+        value = ui_cache[key] = UI_BUILDERS[key]()
+    return value
+
+def get_join_channel_keyboard():
+    return get_ui('join_channel')
+
+def get_main_menu_keyboard(is_admin=False):
+    return get_ui('main_menu', bool(is_admin))
+
+def get_back_button():
+    return get_ui('back')
+
+def get_withdrawal_options_keyboard():
+    return get_ui('withdrawal_options')
+
+def get_withdrawal_amount_keyboard():
+    return get_ui('withdrawal_amount')
+
+def get_redeem_amount_keyboard():
+    return get_ui('redeem_amount')
+
+def get_admin_keyboard():
+    return get_ui('admin')
+
+# Outbound message settings
+SEND_RATE_GLOBAL = 25  # Messages per second across all chats (Telegram allows about 30)
+SEND_RATE_PER_CHAT = 1  # Messages per second to a single chat
+SEND_WORKERS = 8  # Concurrent send_message calls
+SEND_QUEUE_SIZE = 10000  # Messages waiting to be sent before new ones are dropped
+SEND_MAX_RETRIES = 3  # Attempts for messages failing with network errors
+REFERRAL_NOTIFY_WINDOW = 10  # Seconds during which referral notifications are merged
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        # Takes a token if one is available and returns 0, otherwise returns
+        # the seconds until the next token
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+# Queue for messages that don't need to go out on the request path, such as
+# referral notifications and broadcasts. Workers respect a global and a
+# per-chat token bucket and back off on Telegram's retry_after.
+class SendQueue:
+    def __init__(self):
+        self.queue = None
+        self.bot = None
+        self.workers = []
+        self.delayed = set()
+        self.global_bucket = TokenBucket(SEND_RATE_GLOBAL, SEND_RATE_GLOBAL)
+        self.chat_buckets = OrderedDict()
+        self.paused_until = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retried = 0
+
+    def start(self, bot) -> None:
+        self.bot = bot
+        self.queue = asyncio.Queue(SEND_QUEUE_SIZE)
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(SEND_WORKERS)]
+
+    async def stop(self) -> None:
+        delayed = list(self.delayed)
+        for task in self.workers + delayed:
+            task.cancel()
+        await asyncio.gather(*self.workers, *delayed, return_exceptions=True)
+        self.workers = []
+        self.delayed.clear()
+        unsent = len(delayed) + (self.queue.qsize() if self.queue is not None else 0)
+        if unsent:
+            self.dropped += unsent
+            logging.warning(f"Dropping {unsent} unsent messages on shutdown")
+
+    def enqueue(self, chat_id: int, text: str, **kwargs) -> bool:
+        # Never blocks, for use on the request path
+        try:
+            self.queue.put_nowait((chat_id, text, kwargs, 0))
+            return True
+        except (asyncio.QueueFull, AttributeError):
+            self.dropped += 1
+            logging.warning(f"Send queue unavailable or full, dropping message to {chat_id}")
+            return False
+
+    async def put(self, chat_id: int, text: str, **kwargs) -> None:
+        # Waits for room in the queue, for bulk senders such as broadcasts
+        await self.queue.put((chat_id, text, kwargs, 0))
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(SEND_RATE_PER_CHAT, 1)
+            while len(self.chat_buckets) > SEND_QUEUE_SIZE:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def requeue_later(self, item, delay: float) -> None:
+        # Waits for room rather than dropping the retry when the queue has
+        # filled up in the meantime, e.g. during a broadcast
+        task = asyncio.create_task(self.put_later(item, delay))
+        self.delayed.add(task)
+        task.add_done_callback(self.delayed.discard)
+
+    async def put_later(self, item, delay: float) -> None:
+        await asyncio.sleep(delay)
+        await self.queue.put(item)
+
+    async def worker(self) -> None:
+        while True:
+            item = await self.queue.get()
+            try:
+                await self.deliver(item)
+            except Exception as e:
+                logging.error(f"Unexpected error in send queue: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def deliver(self, item) -> None:
+        chat_id, text, kwargs, attempt = item
+
+        # A chat that is over its own limit is retried later without
+        # holding up messages to other chats
+        wait = self.chat_bucket(chat_id).take()
+        if wait:
+            self.requeue_later(item, wait)
+            return
+
+        while True:
+            pause = self.paused_until - time.monotonic()
+            wait = max(pause, self.global_bucket.take())
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            self.sent += 1
+        except RetryAfter as e:
+            delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.retried += 1
+            logging.warning(f"Flood limit hit, pausing sends for {delay}s")
+            self.requeue_later(item, delay)
+        except Forbidden:
+            # The user blocked the bot; nothing to retry
+            self.failed += 1
+        except NetworkError as e:
+            if attempt + 1 < SEND_MAX_RETRIES:
+                self.retried += 1
+                self.requeue_later((chat_id, text, kwargs, attempt + 1), 2 ** attempt)
+            else:
+                self.failed += 1
+                logging.error(f"Failed to send message to {chat_id}: {e}")
+        except TelegramError as e:
+            self.failed += 1
+            logging.error(f"Failed to send message to {chat_id}: {e}")
+
+send_queue = SendQueue()
+
+# referrer_id -> [referrals, amount] credited since the last notification
+pending_referral_notifications = {}
+
+def notify_referral(referrer_id: int, amount: int) -> None:
+    # The first referral is announced right away; more referrals within the
+    # window are summed into a single follow-up message
+    pending = pending_referral_notifications.get(referrer_id)
+    if pending is not None:
+        pending[0] += 1
+        pending[1] += amount
+        return
+    send_queue.enqueue(referrer_id, f"🎉 New referral! You earned ₹{amount}!")
+    pending_referral_notifications[referrer_id] = [0, 0]
+    asyncio.get_running_loop().call_later(REFERRAL_NOTIFY_WINDOW, flush_referral_notification, referrer_id)
+
+def flush_referral_notification(referrer_id: int) -> None:
+    count, amount = pending_referral_notifications.pop(referrer_id, (0, 0))
+    if count == 0:
+        return
+    if count == 1:
+        send_queue.enqueue(referrer_id, f"🎉 New referral! You earned ₹{amount}!")
+    else:
+        send_queue.enqueue(referrer_id, f"🎉 {count} new referrals! You earned ₹{amount}!")
+    pending_referral_notifications[referrer_id] = [0, 0]
+    asyncio.get_running_loop().call_later(REFERRAL_NOTIFY_WINDOW, flush_referral_notification, referrer_id)
+
+def notify_referral_burst(referrer_id: int) -> None:
+    for admin_id in ADMIN_IDS:
+        send_queue.enqueue(
+            admin_id,
+            f"⚠️ Referral burst: user {referrer_id} got {REFERRAL_BURST_THRESHOLD} referrals within an hour.\n"
+            f"Details: /referrals {referrer_id}"
+        )
+
+async def run_broadcast(admin_id: int, text: str) -> None:
+    started = time.perf_counter()
+    queued = 0
+    for user_id in iter_user_ids():
+        await send_queue.put(user_id, text)
+        queued += 1
+    send_queue.enqueue(
+        admin_id,
+        f"📣 Broadcast queued for {queued} users in {time.perf_counter() - started:.1f}s."
+    )
+
+@instrument_handler('broadcast')
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    text = update.message.text.partition(' ')[2].strip()
+    if not text:
+        await update.message.reply_text("Usage: /broadcast <message>")
+        return
+    context.application.create_task(run_broadcast(update.effective_user.id, text))
+    await update.message.reply_text("📣 Broadcast started.", reply_markup=get_admin_keyboard())
+
+def parse_window_hours(text: str, default: int = 24):
+    # '6h', '2d' or a bare number of hours, within the kept history
+    match = re.fullmatch(r'(\d+)([hd]?)', text.strip().lower()) if text else None
+    if text and match is None:
+        return None
+    hours = default if match is None else int(match.group(1)) * (24 if match.group(2) == 'd' else 1)
+    return min(max(hours, 1), REFERRAL_STATS_HOURS)
+
+def format_referrer(user_id: int) -> str:
+    name = display_names.get(user_id)
+    return f"{name} ({user_id})" if name else str(user_id)
+
+@instrument_handler('top_referrers')
+async def top_referrers_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    hours = parse_window_hours(context.args[0] if context.args else '')
+    if hours is None:
+        await update.message.reply_text("Usage: /topreferrers [hours, e.g. 6h or 7d]")
+        return
+    now = int(time.time())
+    text = f"🏆 Top Referrers, last {hours}h:\n\n"
+    for i, (referrer_id, count) in enumerate(referral_graph.top(hours, now), 1):
+        flag = " ⚠️" if referrer_id in referral_graph.flagged else ""
+        text += f"{i}. {format_referrer(referrer_id)}: {count} referrals{flag}\n"
+    await update.message.reply_text(text)
+
+@instrument_handler('referral_info')
+async def referral_info_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    if not context.args or not context.args[0].isdigit() or get_user(int(context.args[0])) is None:
+        await update.message.reply_text("Usage: /referrals <user_id>")
+        return
+    user_id = int(context.args[0])
+    user_data = get_user(user_id)
+    now = int(time.time())
+    flagged_hour = referral_graph.flagged.get(user_id)
+    burst = f"\n⚠️ Burst flagged {datetime.fromtimestamp(flagged_hour * 3600):%Y-%m-%d %H:00}" if flagged_hour else ""
+    await update.message.reply_text(
+        f"🔗 Referrals of {format_referrer(user_id)}:\n\n"
+        f"Referred by: {format_referrer(user_data.referred_by) if user_data.referred_by else 'nobody'}\n"
+        f"Depth: {referral_graph.depth(user_id)}\n"
+        f"Direct referrals: {user_data.referral_count}\n"
+        f"Second level: {referral_graph.second_level(user_id)}\n"
+        f"Whole downline: {referral_graph.downline.get(user_id, 0)}\n"
+        f"Last hour: {referral_graph.recent(user_id, 1, now)}\n"
+        f"Last 24h: {referral_graph.recent(user_id, 24, now)}" + burst
+    )
+
+@instrument_handler('referral_bursts')
+async def referral_bursts_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    if not referral_graph.flagged:
+        await update.message.reply_text("✅ No referral bursts in the last 7 days.")
+        return
+    text = f"⚠️ Referral bursts (≥{REFERRAL_BURST_THRESHOLD} referrals in an hour):\n\n"
+    latest = sorted(referral_graph.flagged.items(), key=lambda item: item[1], reverse=True)
+    for referrer_id, hour in latest[:REFERRAL_TOP_SIZE * 2]:
+        count = referral_graph.hours.get(hour, {}).get(referrer_id, 0)
+        text += f"{format_referrer(referrer_id)}: {count} at {datetime.fromtimestamp(hour * 3600):%Y-%m-%d %H:00}\n"
+    await update.message.reply_text(text)
+
+CONVERSATION_TTLS = {'awaiting_upi': 10 * 60, 'awaiting_redeem': 30 * 60}  # Seconds a user has to finish each flow
+CONVERSATION_SWEEP_INTERVAL = 60  # Seconds between sweeps of expired and idle user_data
+CONVERSATION_PERSIST_INTERVAL = 5  # Seconds between batched writes of changed conversation states
+
+# A user's pending text-input flow lives in user_data['conversation'] as an
+# immutable (state, amount, expires_at) tuple, so only one flow is open at a
+# time and an abandoned one stops counting once it expires.
+def start_conversation(context: ContextTypes.DEFAULT_TYPE, state: str, amount: int = 0) -> None:
+    context.user_data['conversation'] = (state, amount, int(time.time()) + CONVERSATION_TTLS[state])
+
+def get_conversation(context: ContextTypes.DEFAULT_TYPE):
+    return context.user_data.get('conversation')
+
+def end_conversation(context: ContextTypes.DEFAULT_TYPE, state: str):
+    # Ends the flow and returns its amount, or None when it isn't open (any more)
+    conversation = context.user_data.get('conversation')
+    if conversation is None or conversation[0] != state:
+        return None
+    del context.user_data['conversation']
+    return conversation[1] if conversation[2] > time.time() else None
+
+# Persists user_data['conversation'] and nothing else. The application hands
+# over every touched user each update_interval; only states that differ from
+# what was last written reach SQLite, through the storage group commit. On
+# startup only the ids of stored states are read, and a state is loaded into
+# user_data by refresh_user_data just before that user's next update.
+class ConversationPersistence(BasePersistence):
+    def __init__(self, update_interval: float = CONVERSATION_PERSIST_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.written = {}  # user_id -> conversation tuple as stored
+        self.unrestored = set()
+        self.idle = set()  # Touched users without a conversation, for the sweep to drop
+
+    async def get_user_data(self) -> dict:
+        self.unrestored = storage.load_conversation_ids()
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self.unrestored:
+            self.unrestored.discard(user_id)
+            conversation = storage.read_conversation(user_id)
+            if conversation is not None:
+                user_data['conversation'] = self.written[user_id] = conversation
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        conversation = data.get('conversation')
+        if conversation is None:
+            self.idle.add(user_id)
+        if conversation == self.written.get(user_id):
+            return
+        if conversation is None:
+            del self.written[user_id]
+            storage.write(Storage.DELETE_CONVERSATION, (user_id,))
+        else:
+            self.written[user_id] = conversation
+            storage.write(Storage.UPSERT_CONVERSATION, (user_id, *conversation))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self.unrestored.discard(user_id)
+        if self.written.pop(user_id, None) is not None:
+            storage.write(Storage.DELETE_CONVERSATION, (user_id,))
+
+    async def flush(self) -> None:
+        storage.flush()
+
+    # Chat, bot and callback data and ConversationHandler states aren't used
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
 
-def get_redeem_amount_keyboard():
-    amounts = [10, 20, 50, 100, 200, 300]
-    keyboard = []
-    for i in range(0, len(amounts), 2):
-        row = []
-        row.append(InlineKeyboardButton(f"₹{amounts[i]}", callback_data=f'redeem_{amounts[i]}'))
-        if i + 1 < len(amounts):
-            row.append(InlineKeyboardButton(f"₹{amounts[i+1]}", callback_data=f'redeem_{amounts[i+1]}'))
-        keyboard.append(row)
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='withdraw')])
-    return InlineKeyboardMarkup(keyboard)
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
 
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+async def sweep_conversations(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # JobQueue callback. Drops the user_data of expired flows and of users
+    # without one, so neither accumulates for every user ever seen.
+    application = context.application
+    persistence = application.persistence
+    if not isinstance(persistence, ConversationPersistence):
+        return
+    now = time.time()
+    # A handler still running for a user may write to the user_data it holds
+    busy = getattr(application.update_processor, 'backlogs', {})
+    expired = 0
+    for user_id in list(persistence.written):
+        conversation = application.user_data.get(user_id, {}).get('conversation')
+        if conversation is not None and conversation[2] <= now and user_id not in busy:
+            application.drop_user_data(user_id)
+            expired += 1
+    for user_id in persistence.idle:
+        if user_id not in busy and not application.user_data.get(user_id):
+            application.drop_user_data(user_id)
+    persistence.idle.clear()
+    if expired:
+        logging.info(f"Expired {expired} abandoned conversations")
+
+@instrument_handler('start')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     user_id = user.id
+    remember_display_name(user_id, user.first_name)
     
     # Check channel membership
     if not await check_channel_membership(user_id, context):
@@ -135,271 +1938,565 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     # Initialize user data if not exists
-    if user_id not in users:
-        users[user_id] = {
-            'balance': 0,
-            'referrals': [],
-            'referred_by': None,
-            'join_date': datetime.now(),
-            'total_earned': 0,
-            'total_withdrawn': 0,
-            'last_active': datetime.now()
-        }
+    async with lock_users(user_id):
+        if get_user(user_id) is None:
+            create_user(user_id)
     
     # Check if user was referred
     if context.args and len(context.args) > 0:
         referrer_id = int(context.args[0])
-        if referrer_id != user_id and referrer_id in users and user_id not in users[referrer_id]['referrals']:
-            users[referrer_id]['referrals'].append(user_id)
-            users[referrer_id]['balance'] += REFERRAL_BONUS
-            users[user_id]['referred_by'] = referrer_id
-            try:
-                await context.bot.send_message(
-                    chat_id=referrer_id,
-                    text=f"🎉 New referral! You earned ₹{REFERRAL_BONUS}!"
-                )
-            except Exception as e:
-                logging.error(f"Failed to send referral notification: {e}")
+        credited = burst = False
+        key = update_key(update, 'referral')
+        async with lock_users(user_id, referrer_id):
+            # A redelivered update must not record the referral a second time
+            if key not in ledger_keys and can_refer(referrer_id, user_id):
+                burst = add_referral(referrer_id, user_id)
+                post_ledger_entry(referrer_id, REFERRAL_BONUS, 'referral', key)
+                credited = True
+        if credited:
+            notify_referral(referrer_id, REFERRAL_BONUS)
+        if burst:
+            notify_referral_burst(referrer_id)
     
     reply_markup = get_main_menu_keyboard()
     
-    welcome_message = (
-        f"Welcome {user.first_name}! 🎉\n\n"
-        "I'm your Referral Earning Bot. Earn ₹10 for each successful referral!\n\n"
-        "Use the buttons below to:\n"
-        "- Check your balance 💰\n"
-        "- Get your referral link 🔗\n"
-        "- Withdraw your earnings 💸\n"
-        "- Claim daily bonus 🎁\n"
-        "- Learn how to earn more ℹ️"
-    )
+    welcome_message = f"Welcome {user.first_name}! 🎉\n\n" + get_ui('welcome_text')
     
     await update.message.reply_text(welcome_message, reply_markup=reply_markup)
 
-def get_admin_keyboard():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📝 Pending Withdrawals", callback_data='admin_withdrawals'),
-         InlineKeyboardButton("👥 User List", callback_data='admin_users')],
-        [InlineKeyboardButton("🎫 Manage Codes", callback_data='admin_codes'),
-         InlineKeyboardButton("📊 Statistics", callback_data='admin_stats')],
-        [InlineKeyboardButton("🔙 Back to Menu", callback_data='back_to_menu')]
-    ])
-
 def get_leaderboard():
-    sorted_users = sorted(users.items(), key=lambda x: len(x[1]['referrals']), reverse=True)
-    return sorted_users[:10]
+    return leaderboard_index.top(LEADERBOARD_SIZE)
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    user_id = query.from_user.id
-    is_admin = user_id in ADMIN_IDS
-    
-    await query.answer()
-    
-    if query.data == 'check_membership':
-        if await check_channel_membership(user_id, context):
-            await query.message.edit_text(
-                "✅ Thank you for joining! Here's the main menu:",
-                reply_markup=get_main_menu_keyboard()
-            )
+async def render_leaderboard(context: ContextTypes.DEFAULT_TYPE) -> str:
+    key = (leaderboard_index.version, display_names_version)
+    if leaderboard_text_cache['key'] == key:
+        count_cache('leaderboard_text', True)
+        return leaderboard_text_cache['text']
+    count_cache('leaderboard_text', False)
+
+    top_users = get_leaderboard()
+    missing = [uid for uid, _ in top_users if uid not in display_names]
+    display_stats = cache_stats['display_names']
+    display_stats[0] += len(top_users) - len(missing)
+    display_stats[1] += len(missing)
+    fetched = await asyncio.gather(*(fetch_display_name(uid, context) for uid in missing))
+    names = dict(zip(missing, fetched))
+
+    leaderboard_text = "🏆 Top Referrers:\n\n"
+    complete = True
+    for i, (uid, referrals) in enumerate(top_users, 1):
+        name = display_names.get(uid) or names.get(uid)
+        if name is None:
+            complete = False
+            continue
+        leaderboard_text += f"{i}. {name}: {referrals} referrals\n"
+
+    # Don't memoize a list with holes, so failed lookups are retried next time
+    if complete:
+        leaderboard_text_cache['key'] = key
+        leaderboard_text_cache['text'] = leaderboard_text
+    return leaderboard_text
+
+# Callback query router. Exact callback data is matched with one dict lookup and
+# parameterized data (e.g. 'redeem_50') by the longest registered prefix in a
+# trie. Each route carries its own admin/membership guards and latency histogram.
+Route = namedtuple('Route', ['name', 'func', 'admin', 'membership', 'is_prefix'])
+
+class CallbackRouter:
+    def __init__(self):
+        self.exact = {}
+        self.trie = {}
+        self.stats = {}
+
+    def route(self, data: str, admin: bool = False, membership: bool = True):
+        def decorator(func):
+            self.exact[data] = Route(data, func, admin, membership, False)
+            self.stats[data] = Histogram()
+            return func
+        return decorator
+
+    def prefix(self, prefix: str, admin: bool = False, membership: bool = True):
+        def decorator(func):
+            node = self.trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[None] = Route(prefix, func, admin, membership, True)
+            self.stats[prefix] = Histogram()
+            return func
+        return decorator
+
+    def resolve(self, data: str):
+        route = self.exact.get(data)
+        if route is not None:
+            return route, None
+        match = None
+        node = self.trie
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                match = node[None]
+        if match is None:
+            return None, None
+        return match, data[len(match.name):]
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        query = update.callback_query
+        route, param = self.resolve(query.data)
+        if route is None:
             return
-        else:
+
+        user_id = query.from_user.id
+        if route.membership and not await check_channel_membership(user_id, context):
             await query.message.edit_text(
-                "❌ You haven't joined our channel yet. Please join to continue:",
+                "🔔 Please join our channel to use the bot!",
                 reply_markup=get_join_channel_keyboard()
             )
             return
+        if route.admin and user_id not in ADMIN_IDS:
+            return
+
+        started = time.perf_counter()
+        failed = True
+        try:
+            if route.is_prefix:
+                await route.func(update, context, param)
+            else:
+                await route.func(update, context)
+            failed = False
+        finally:
+            self.stats[route.name].observe(time.perf_counter() - started, failed)
+
+router = CallbackRouter()
+
+@instrument_handler('button_handler')
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    remember_display_name(query.from_user.id, query.from_user.first_name)
     
-    # Check channel membership for all other actions
-    if not await check_channel_membership(user_id, context):
-        await query.message.edit_text(
-            "🔔 Please join our channel to use the bot!",
-            reply_markup=get_join_channel_keyboard()
-        )
-        return
-        
-    if query.data == 'back_to_menu':
+    await query.answer()
+    await router.dispatch(update, context)
+
+@router.route('check_membership', membership=False)
+async def on_check_membership(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user_id = query.from_user.id
+    # The user says they just joined, so don't trust a cached "not joined"
+    invalidate_membership_cache(user_id)
+    if await check_channel_membership(user_id, context):
         await query.message.edit_text(
-            "Choose an option from the main menu:",
+            "✅ Thank you for joining! Here's the main menu:",
             reply_markup=get_main_menu_keyboard()
         )
-        return
-    
-    if query.data == 'check_balance':
-        if user_id in users:
-            balance = users[user_id]['balance']
-            referral_count = len(users[user_id]['referrals'])
-            await query.message.edit_text(
-                f"💰 Your Balance: ₹{balance}\n"
-                f"👥 Total Referrals: {referral_count}",
-                reply_markup=get_back_button()
-            )
-    
-    elif query.data == 'get_referral':
-        referral_link = f"https://t.me/{BOT_USERNAME}?start={user_id}"
+    else:
         await query.message.edit_text(
-            f"🔗 Share this link to earn ₹{REFERRAL_BONUS} per referral:\n\n"
-            f"{referral_link}",
-            reply_markup=get_back_button()
+            "❌ You haven't joined our channel yet. Please join to continue:",
+            reply_markup=get_join_channel_keyboard()
         )
-    
-    elif query.data == 'withdraw':
-        if user_id in users:
-            balance = users[user_id]['balance']
-            if balance >= MIN_WITHDRAWAL:
-                await query.message.edit_text(
-                    f"💰 Your Balance: ₹{balance}\n\n"
-                    "Choose your withdrawal method:",
-                    reply_markup=get_withdrawal_options_keyboard()
-                )
-            else:
-                await query.message.edit_text(
-                    f"❌ Minimum withdrawal amount is ₹{MIN_WITHDRAWAL}.\n"
-                    f"Current balance: ₹{balance}",
-                    reply_markup=get_back_button()
-                )
-    
-    elif query.data == 'withdraw_upi':
+
+@router.route('back_to_menu')
+async def on_back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.callback_query.message.edit_text(
+        "Choose an option from the main menu:",
+        reply_markup=get_main_menu_keyboard()
+    )
+
+@router.route('check_balance')
+async def on_check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user_data = get_user(query.from_user.id)
+    if user_data is not None:
+        balance = user_data.balance
+        referral_count = user_data.referral_count
         await query.message.edit_text(
-            "Select withdrawal amount:",
-            reply_markup=get_withdrawal_amount_keyboard()
+            f"💰 Your Balance: ₹{balance}\n"
+            f"👥 Total Referrals: {referral_count}",
+            reply_markup=get_back_button()
         )
-    
-    elif query.data.startswith('redeem_'):
-        amount = int(query.data.split('_')[1])
-        if users[user_id]['balance'] >= amount:
-            matching_code = next((code for code, value in redeem_codes.items() if value == amount), None)
-            if matching_code:
-                users[user_id]['balance'] -= amount
-                await query.message.edit_text(
-                    f"Here's your redeem code for ₹{amount}:\n\n"
-                    f"`{matching_code}`\n\n"
-                    "Copy and send this code to redeem your reward!\n"
-                    f"New balance: ₹{users[user_id]['balance']}",
-                    reply_markup=get_back_button()
-                )
-                context.user_data['awaiting_redeem'] = True
-            else:
-                await query.message.edit_text(
-                    "❌ No redeem code available for this amount.",
-                    reply_markup=get_back_button()
-                )
-        else:
-            await query.message.edit_text(
-                f"❌ Insufficient balance. You need ₹{amount} but have ₹{users[user_id]['balance']}.",
-                reply_markup=get_back_button()
-            )
 
-    elif query.data.startswith('amount_'):
-        amount = int(query.data.split('_')[1])
-        if users[user_id]['balance'] >= amount:
-            context.user_data['withdrawal_amount'] = amount
+@router.route('get_referral')
+async def on_get_referral(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    referral_link = f"https://t.me/{BOT_USERNAME}?start={query.from_user.id}"
+    await query.message.edit_text(
+        f"🔗 Share this link to earn ₹{REFERRAL_BONUS} per referral:\n\n"
+        f"{referral_link}",
+        reply_markup=get_back_button()
+    )
+
+@router.route('withdraw')
+async def on_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user_data = get_user(query.from_user.id)
+    if user_data is not None:
+        balance = user_data.balance
+        if balance >= MIN_WITHDRAWAL:
             await query.message.edit_text(
-                f"Please enter your UPI ID to receive ₹{amount}:\n"
-                "(Send your UPI ID in the next message)",
-                reply_markup=get_back_button()
+                f"💰 Your Balance: ₹{balance}\n\n"
+                "Choose your withdrawal method:",
+                reply_markup=get_withdrawal_options_keyboard()
             )
-            context.user_data['awaiting_upi'] = True
         else:
             await query.message.edit_text(
-                "❌ Insufficient balance for this amount.",
-                reply_markup=get_withdrawal_options_keyboard()
+                f"❌ Minimum withdrawal amount is ₹{MIN_WITHDRAWAL}.\n"
+                f"Current balance: ₹{balance}",
+                reply_markup=get_back_button()
             )
-    
-    elif query.data == 'withdraw_redeem':
-        await query.message.edit_text(
-            "Select redeem amount:",
-            reply_markup=get_redeem_amount_keyboard()
-        )
-    
-    elif query.data == 'daily_bonus':
-        now = datetime.now()
-        last_claim = daily_bonus.get(user_id, None)
-        
-        if last_claim is None or (now - last_claim).days >= 1:
-            users[user_id]['balance'] += DAILY_BONUS_AMOUNT
-            daily_bonus[user_id] = now
+
+@router.route('withdraw_upi')
+async def on_withdraw_upi(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.callback_query.message.edit_text(
+        "Select withdrawal amount:",
+        reply_markup=get_withdrawal_amount_keyboard()
+    )
+
+@router.prefix('redeem_')
+async def on_redeem_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    query = update.callback_query
+    user_id = query.from_user.id
+    amount = int(param)
+    key = update_key(update, 'redeem_issue')
+    async with lock_users(user_id):
+        # A redelivered update was answered the first time; issuing again
+        # would hand out a second code without charging for it
+        if key in ledger_keys:
+            return
+        user_data = get_user(user_id)
+        sufficient = user_data.balance >= amount
+        matching_code = issue_redeem_code(amount, user_id) if sufficient else None
+        if matching_code:
+            post_ledger_entry(user_id, -amount, 'redeem_issue', key)
+    if sufficient:
+        if matching_code:
+            start_conversation(context, 'awaiting_redeem')
             await query.message.edit_text(
-                f"🎁 You claimed your daily bonus of ₹{DAILY_BONUS_AMOUNT}!\n"
-                f"New balance: ₹{users[user_id]['balance']}",
+                f"Here's your redeem code for ₹{amount}:\n\n"
+                f"`{matching_code}`\n\n"
+                "Copy and send this code to redeem your reward!\n"
+                f"New balance: ₹{user_data.balance}",
                 reply_markup=get_back_button()
             )
         else:
-            next_claim = last_claim + timedelta(days=1)
-            hours_left = (next_claim - now).seconds // 3600
             await query.message.edit_text(
-                f"⏳ You can claim your next bonus in {hours_left} hours.",
+                "❌ No redeem code available for this amount.",
                 reply_markup=get_back_button()
             )
+    else:
+        await query.message.edit_text(
+            f"❌ Insufficient balance. You need ₹{amount} but have ₹{user_data.balance}.",
+            reply_markup=get_back_button()
+        )
+
+@router.prefix('amount_')
+async def on_withdrawal_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    query = update.callback_query
+    amount = int(param)
+    if amount not in WITHDRAWAL_AMOUNTS:
+        # Keyboards sent before a config change can still carry old amounts
+        await query.message.edit_text(
+            "❌ This amount is no longer available. Select withdrawal amount:",
+            reply_markup=get_withdrawal_amount_keyboard()
+        )
+        return
+    if get_user(query.from_user.id).balance >= amount:
+        start_conversation(context, 'awaiting_upi', amount)
+        await query.message.edit_text(
+            f"Please enter your UPI ID to receive ₹{amount}:\n"
+            "(Send your UPI ID in the next message)",
+            reply_markup=get_back_button()
+        )
+    else:
+        await query.message.edit_text(
+            "❌ Insufficient balance for this amount.",
+            reply_markup=get_withdrawal_options_keyboard()
+        )
+
+@router.route('withdraw_redeem')
+async def on_withdraw_redeem(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.callback_query.message.edit_text(
+        "Select redeem amount:",
+        reply_markup=get_redeem_amount_keyboard()
+    )
+
+@router.route('daily_bonus')
+async def on_daily_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user_id = query.from_user.id
+    async with lock_users(user_id):
+        now = int(time.time())
+        next_claim = get_next_bonus_time(user_id)
+        claimed = now >= next_claim
+        if claimed:
+            post_ledger_entry(user_id, DAILY_BONUS_AMOUNT, 'daily_bonus', update_key(update, 'daily_bonus'))
+            set_daily_bonus_claim(user_id, now)
     
-    elif query.data == 'how_to_earn':
-        earning_info = (
-            "💡 How to Earn:\n\n"
-            f"1. Refer Friends: ₹{REFERRAL_BONUS} per referral\n"
-            f"2. Daily Bonus: ₹{DAILY_BONUS_AMOUNT} every 24 hours\n\n"
-            f"Minimum withdrawal: ₹{MIN_WITHDRAWAL}"
+    if claimed:
+        user_data = get_user(user_id)
+        await query.message.edit_text(
+            f"🎁 You claimed your daily bonus of ₹{DAILY_BONUS_AMOUNT}!\n"
+            f"New balance: ₹{user_data.balance}",
+            reply_markup=get_back_button()
+        )
+    else:
+        await query.message.edit_text(
+            f"⏳ You can claim your next bonus in {format_wait(next_claim - now)}.",
+            reply_markup=get_back_button()
         )
-        await query.message.edit_text(earning_info, reply_markup=get_back_button())
 
-    elif query.data == 'leaderboard':
-        top_users = get_leaderboard()
-        leaderboard_text = "🏆 Top Referrers:\n\n"
-        for i, (uid, data) in enumerate(top_users, 1):
-            try:
-                user = await context.bot.get_chat(uid)
-                name = user.first_name
-                referrals = len(data['referrals'])
-                leaderboard_text += f"{i}. {name}: {referrals} referrals\n"
-            except Exception:
-                continue
-        await query.message.edit_text(leaderboard_text, reply_markup=get_back_button())
-
-    elif query.data == 'my_stats':
-        user_data = users[user_id]
-        stats = (
-            "📊 Your Statistics:\n\n"
-            f"Total Earned: ₹{user_data['total_earned']}\n"
-            f"Total Withdrawn: ₹{user_data['total_withdrawn']}\n"
-            f"Active Days: {(datetime.now() - user_data['join_date']).days}\n"
-            f"Referrals: {len(user_data['referrals'])}\n"
+def format_wait(seconds: int) -> str:
+    # Rounded up to the minute, so "0 minutes" is never shown
+    hours, minutes = divmod(-(-seconds // 60), 60)
+    if hours and minutes:
+        return f"{hours}h {minutes}m"
+    if hours:
+        return f"{hours} hours" if hours > 1 else "1 hour"
+    return f"{minutes} minutes" if minutes > 1 else "1 minute"
+
+async def sweep_daily_bonus(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # JobQueue callback, run at every bucket boundary
+    due = expire_daily_bonus_claims(int(time.time()))
+    if not due or not DAILY_BONUS_REMINDERS:
+        return
+    started = time.perf_counter()
+    sent = 0
+    for user_id in due:
+        # Skip users who already claimed again since the bucket became due
+        if get_daily_bonus_claim(user_id) is not None:
+            continue
+        # put() waits for room, so large buckets drain at the send queue's rate
+        await send_queue.put(
+            user_id,
+            f"🎁 Your daily bonus of ₹{DAILY_BONUS_AMOUNT} is ready to claim!",
+            reply_markup=get_ui('bonus_ready')
         )
-        await query.message.edit_text(stats, reply_markup=get_back_button())
+        sent += 1
+    logging.info(f"Queued {sent} daily bonus reminders in {time.perf_counter() - started:.1f}s")
 
-    elif query.data == 'admin_panel' and is_admin:
-        await query.message.edit_text("👑 Admin Panel", reply_markup=get_admin_keyboard())
+@router.route('how_to_earn')
+async def on_how_to_earn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.callback_query.message.edit_text(get_ui('how_to_earn_text'), reply_markup=get_back_button())
 
-    elif query.data == 'admin_withdrawals' and is_admin:
-        if not withdrawal_requests:
-            await query.message.edit_text("No pending withdrawals.", reply_markup=get_admin_keyboard())
-        else:
-            text = "📝 Pending Withdrawals:\n\n"
-            for req_id, req_data in withdrawal_requests.items():
-                text += f"User: {req_data['user_id']}\n"
-                text += f"Amount: ₹{req_data['amount']}\n"
-                text += f"UPI: {req_data['upi']}\n\n"
-            await query.message.edit_text(text, reply_markup=get_admin_keyboard())
-
-    elif query.data == 'admin_users' and is_admin:
-        total_users = len(users)
-        active_users = sum(1 for u in users.values() if (datetime.now() - u['last_active']).days < 7)
-        text = f"👥 User Statistics:\n\nTotal Users: {total_users}\nActive Users (7d): {active_users}"
-        await query.message.edit_text(text, reply_markup=get_admin_keyboard())
-
-    elif query.data == 'admin_stats' and is_admin:
-        total_withdrawn = sum(u['total_withdrawn'] for u in users.values())
-        total_earned = sum(u['total_earned'] for u in users.values())
-        text = (
-            "📊 Platform Statistics:\n\n"
-            f"Total Withdrawn: ₹{total_withdrawn}\n"
-            f"Total Earned: ₹{total_earned}\n"
-            f"Active Codes: {len(redeem_codes)}\n"
-            f"Used Codes: {len(used_codes)}"
+@router.route('leaderboard')
+async def on_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user_id = query.from_user.id
+    leaderboard_text = await render_leaderboard(context)
+    rank = leaderboard_index.rank(user_id)
+    if rank is not None:
+        leaderboard_text += f"\nYou are #{rank} with {leaderboard_index.counts[user_id]} referrals"
+    await query.message.edit_text(leaderboard_text, reply_markup=get_back_button())
+
+@router.route('my_stats')
+async def on_my_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    user_data = get_user(query.from_user.id)
+    stats = (
+        "📊 Your Statistics:\n\n"
+        f"Total Earned: ₹{user_data.total_earned}\n"
+        f"Total Withdrawn: ₹{user_data.total_withdrawn}\n"
+        f"Active Days: {(int(time.time()) - user_data.join_ts) // 86400}\n"
+        f"Referrals: {user_data.referral_count}\n"
+    )
+    await query.message.edit_text(stats, reply_markup=get_back_button())
+
+@router.route('admin_panel', admin=True)
+async def on_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.callback_query.message.edit_text("👑 Admin Panel", reply_markup=get_admin_keyboard())
+
+def render_withdrawals_page(after_seq: int = 0, notice: str = "") -> tuple:
+    requests = withdrawal_queue.page(after_seq)
+    if not requests and after_seq:
+        after_seq = 0
+        requests = withdrawal_queue.page()
+    if not requests:
+        return notice + "No pending withdrawals.", get_admin_keyboard()
+
+    parts = [notice, f"📝 Pending Withdrawals ({len(withdrawal_queue)} total):\n\n"]
+    keyboard = []
+    for request in requests:
+        position = withdrawal_queue.position(request.seq)
+        parts.append(
+            f"#{position} · {datetime.fromtimestamp(request.timestamp):%Y-%m-%d %H:%M}\n"
+            f"User: {request.user_id}\n"
+            f"Amount: ₹{request.amount}\n"
+            f"UPI: {request.upi[:64]}\n\n"
         )
-        await query.message.edit_text(text, reply_markup=get_admin_keyboard())
+        keyboard.append([
+            InlineKeyboardButton(f"✅ Approve #{position}", callback_data=f'wd_ok_{request.seq}_{after_seq}'),
+            InlineKeyboardButton(f"❌ Reject #{position}", callback_data=f'wd_no_{request.seq}_{after_seq}')
+        ])
 
+    navigation = []
+    if after_seq:
+        navigation.append(InlineKeyboardButton("⏮ First", callback_data='admin_withdrawals'))
+    if withdrawal_queue.has_more(requests[-1].seq):
+        navigation.append(InlineKeyboardButton("Next ▶", callback_data=f'wd_page_{requests[-1].seq}'))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("📄 Export CSV", callback_data='wd_export')])
+    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data='admin_panel')])
+    return "".join(parts), InlineKeyboardMarkup(keyboard)
+
+@router.route('admin_withdrawals', admin=True)
+async def on_admin_withdrawals(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    text, reply_markup = render_withdrawals_page()
+    await update.callback_query.message.edit_text(text, reply_markup=reply_markup)
+
+@router.prefix('wd_page_', admin=True)
+async def on_withdrawals_page(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    text, reply_markup = render_withdrawals_page(int(param))
+    await update.callback_query.message.edit_text(text, reply_markup=reply_markup)
+
+async def review_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str, approve: bool) -> None:
+    query = update.callback_query
+    seq, _, cursor = param.partition('_')
+    seq = int(seq)
+    request = withdrawal_queue.get(seq)
+
+    notice = "⚠️ That request was already handled.\n\n"
+    if request is not None:
+        async with lock_users(request.user_id):
+            request = resolve_withdrawal_request(seq, 'approved' if approve else 'rejected', query.from_user.id)
+            if request is not None and not approve:
+                # Give the money back; keyed on the request so it can only happen once
+                post_ledger_entry(request.user_id, request.amount, 'withdrawal_refund',
+                                  f"refund:{request.request_id}", withdrawn=-request.amount)
+        if request is not None:
+            if approve:
+                notice = f"✅ Approved ₹{request.amount} for user {request.user_id}.\n\n"
+                send_queue.enqueue(request.user_id, f"✅ Your withdrawal of ₹{request.amount} has been paid.")
+            else:
+                notice = f"❌ Rejected ₹{request.amount} for user {request.user_id} (refunded).\n\n"
+                send_queue.enqueue(
+                    request.user_id,
+                    f"❌ Your withdrawal of ₹{request.amount} was rejected. The amount has been refunded."
+                )
+
+    text, reply_markup = render_withdrawals_page(int(cursor or 0), notice)
+    await query.message.edit_text(text, reply_markup=reply_markup)
+
+@router.prefix('wd_ok_', admin=True)
+async def on_withdrawal_approve(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    await review_withdrawal(update, context, param, approve=True)
+
+@router.prefix('wd_no_', admin=True)
+async def on_withdrawal_reject(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    await review_withdrawal(update, context, param, approve=False)
+
+async def write_withdrawals_csv(file) -> int:
+    # Writes the pending queue chunk by chunk, yielding to the event loop in between
+    text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(['request_id', 'user_id', 'amount', 'upi', 'requested_at'])
+    count = 0
+    after_seq = 0
+    while True:
+        chunk = withdrawal_queue.page(after_seq, WITHDRAWAL_EXPORT_CHUNK)
+        if not chunk:
+            break
+        writer.writerows(
+            (r.request_id, r.user_id, r.amount, r.upi, datetime.fromtimestamp(r.timestamp).isoformat())
+            for r in chunk
+        )
+        count += len(chunk)
+        after_seq = chunk[-1].seq
+        await asyncio.sleep(0)
+    text.flush()
+    text.detach()
+    return count
+
+@router.route('wd_export', admin=True)
+async def on_withdrawals_export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    with tempfile.TemporaryFile() as file:
+        count = await write_withdrawals_csv(file)
+        file.seek(0)
+        await context.bot.send_document(
+            chat_id=query.message.chat_id,
+            document=file,
+            filename=f"pending_withdrawals_{datetime.now():%Y%m%d_%H%M%S}.csv",
+            caption=f"📄 {count} pending withdrawals"
+        )
+
+@router.route('admin_users', admin=True)
+async def on_admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    total_users = count_users()
+    active_users = count_active_users()
+    text = f"👥 User Statistics:\n\nTotal Users: {total_users}\nActive Users ({ACTIVE_WINDOW_DAYS}d): {active_users}"
+    await update.callback_query.message.edit_text(text, reply_markup=get_admin_keyboard())
+
+@router.route('admin_stats', admin=True)
+async def on_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    totals = get_platform_stats()
+    text = (
+        "📊 Platform Statistics:\n\n"
+        f"Total Withdrawn: ₹{totals['total_withdrawn']}\n"
+        f"Total Earned: ₹{totals['total_earned']}\n"
+        f"Active Codes: {count_redeem_codes()}\n"
+        f"Used Codes: {count_used_codes()}"
+    )
+    await update.callback_query.message.edit_text(text, reply_markup=get_admin_keyboard())
+
+@router.route('admin_codes', admin=True)
+async def on_admin_codes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.callback_query.message.edit_text(format_code_stock(), reply_markup=get_admin_keyboard())
+
+def format_code_stock() -> str:
+    stock = redeem_pool.stock()
+    text = "🎫 Redeem Code Stock:\n\n"
+    for amount in sorted(set(REDEEM_AMOUNTS) | set(stock)):
+        count = stock.get(amount, 0)
+        warning = " ⚠️ Low stock" if count < LOW_STOCK_THRESHOLD else ""
+        text += f"₹{amount}: {count} available{warning}\n"
+    text += (
+        f"\nIssued: {redeem_pool.counts[CODE_ISSUED]}\n"
+        f"Redeemed: {redeem_pool.counts[CODE_REDEEMED]}\n\n"
+        "To import codes, send a .txt or .csv file with one CODE,AMOUNT per line."
+    )
+    return text
+
+@router.route('admin_perf', admin=True)
+async def on_admin_perf(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.callback_query.message.edit_text(format_perf_report(), reply_markup=get_admin_keyboard())
+
+def format_histogram_line(name: str, histogram: Histogram) -> str:
+    errors = f", {histogram.errors} err" if histogram.errors else ""
+    return (
+        f"{name}: {histogram.count} · p50 {histogram.percentile(0.5) * 1000:.1f}ms"
+        f" · p99 {histogram.percentile(0.99) * 1000:.1f}ms{errors}\n"
+    )
+
+def format_perf_report() -> str:
+    text = "📈 Performance:\n\nHandlers\n"
+    for name, histogram in handler_metrics.items():
+        if histogram.count:
+            text += format_histogram_line(name, histogram)
+
+    # Only the busiest routes and API methods, to stay well within a message
+    text += "\nTop Routes\n"
+    routes = sorted(router.stats.items(), key=lambda item: item[1].count, reverse=True)
+    for name, histogram in routes[:8]:
+        if histogram.count:
+            text += format_histogram_line(name, histogram)
+
+    text += "\nBot API\n"
+    methods = sorted(api_metrics.items(), key=lambda item: item[1].count, reverse=True)
+    for name, histogram in methods[:8]:
+        text += format_histogram_line(name, histogram)
+
+    text += "\nCache Hit Ratio\n"
+    for name, (hits, misses) in cache_stats.items():
+        total = hits + misses
+        ratio = f"{hits * 100 / total:.1f}%" if total else "n/a"
+        text += f"{name}: {ratio} of {total}\n"
+    return text
+
+@instrument_handler('handle_message')
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     message_text = update.message.text
+    remember_display_name(user_id, update.effective_user.first_name)
     
     if not await check_channel_membership(user_id, context):
         await update.message.reply_text(
@@ -408,50 +2505,75 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return
     
-    if context.user_data.get('awaiting_upi'):
-        amount = context.user_data.get('withdrawal_amount')
-        # Process UPI withdrawal
-        request_id = f"{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        withdrawal_requests[request_id] = {
-            'user_id': user_id,
-            'amount': amount,
-            'upi': message_text,
-            'timestamp': datetime.now()
-        }
+    # A code issued to this user was paid for, so it can be sent at any
+    # time, even after the conversation that issued it has timed out
+    code = message_text.strip().upper()
+    holds_code = redeem_pool.issued_to.get(code) == user_id
+
+    conversation = get_conversation(context)
+    if holds_code:
+        state = 'awaiting_redeem'
+    elif conversation is not None and conversation[2] <= time.time():
+        del context.user_data['conversation']
+        await update.message.reply_text(
+            "⌛ That request timed out. Please start again from the menu.",
+            reply_markup=get_main_menu_keyboard(is_admin=(user_id in ADMIN_IDS))
+        )
+        return
+    else:
+        state = conversation[0] if conversation is not None else None
+
+    if state == 'awaiting_upi':
+        # Process UPI withdrawal, re-checking the balance under the user's lock
+        key = update_key(update, 'withdrawal')
+        async with lock_users(user_id):
+            amount = end_conversation(context, 'awaiting_upi')
+            # A redelivered update already filed its request the first time
+            if amount is None or key in ledger_keys:
+                return
+            try:
+                post_ledger_entry(user_id, -amount, 'withdrawal', key, withdrawn=amount, touch=True)
+            except InsufficientBalance:
+                request = None
+            else:
+                request = add_withdrawal_request(user_id, amount, message_text)
+        
+        if request is None:
+            await update.message.reply_text(
+                f"❌ Insufficient balance for a ₹{amount} withdrawal.",
+                reply_markup=get_main_menu_keyboard(is_admin=(user_id in ADMIN_IDS))
+            )
+            return
         
         await update.message.reply_text(
             f"✅ Withdrawal request received!\n\n"
-            f"Request ID: {request_id}\n"
+            f"Request ID: {request.request_id}\n"
             f"Amount: ₹{amount}\n"
             f"UPI ID: {message_text}\n\n"
             "Your payment will be processed shortly.",
             reply_markup=get_main_menu_keyboard(is_admin=(user_id in ADMIN_IDS))
         )
-        users[user_id]['balance'] -= amount
-        users[user_id]['total_withdrawn'] += amount
-        users[user_id]['last_active'] = datetime.now()
-        context.user_data.pop('awaiting_upi', None)
-        context.user_data.pop('withdrawal_amount', None)
     
-    elif context.user_data.get('awaiting_redeem'):
+    elif state == 'awaiting_redeem':
         # Process redeem code
-        code = message_text.strip().upper()
-        if code in used_codes:
+        async with lock_users(user_id):
+            if end_conversation(context, 'awaiting_redeem') is None and not holds_code:
+                return
+            state, amount = use_redeem_code(code, user_id)
+            if amount is not None:
+                post_ledger_entry(user_id, amount, 'redeem', update_key(update, 'redeem'),
+                                  earned=amount, touch=True)
+        if state == CODE_REDEEMED:
             await update.message.reply_text(
                 "❌ This code has already been used!",
                 reply_markup=get_main_menu_keyboard(is_admin=(user_id in ADMIN_IDS))
             )
-        elif code in redeem_codes:
-            amount = redeem_codes[code]
-            users[user_id]['balance'] += amount
-            users[user_id]['total_earned'] += amount
-            users[user_id]['last_active'] = datetime.now()
-            used_codes.add(code)
-            del redeem_codes[code]  # Auto-delete used code
+        elif amount is not None:
+            user_data = get_user(user_id)
             await update.message.reply_text(
                 f"✅ Code successfully redeemed!\n\n"
                 f"Reward: ₹{amount}\n"
-                f"New balance: ₹{users[user_id]['balance']}",
+                f"New balance: ₹{user_data.balance}",
                 reply_markup=get_main_menu_keyboard(is_admin=(user_id in ADMIN_IDS))
             )
         else:
@@ -459,19 +2581,368 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 "❌ Invalid redeem code!",
                 reply_markup=get_main_menu_keyboard(is_admin=(user_id in ADMIN_IDS))
             )
-        context.user_data.pop('awaiting_redeem', None)
+
+async def on_shutdown(application: Application) -> None:
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await send_queue.stop()
+
+    # Commit any writes still waiting for the next group commit
+    storage.close()
+
+def parse_code_import(text: str) -> tuple:
+    # Accepts "CODE,AMOUNT" lines (also ';' or whitespace separated)
+    rows = []
+    invalid = 0
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = re.split(r'[,;\s]+', line)
+        if len(parts) != 2 or not parts[1].isdigit() or int(parts[1]) <= 0:
+            invalid += 1
+            continue
+        rows.append((parts[0].upper(), int(parts[1])))
+    return rows, invalid
+
+@instrument_handler('code_import')
+async def handle_code_import(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+
+    document = update.message.document
+    if document.file_size and document.file_size > CODE_IMPORT_MAX_BYTES:
+        await update.message.reply_text(
+            f"❌ File too large. Maximum size is {CODE_IMPORT_MAX_BYTES // (1024 * 1024)} MB.",
+            reply_markup=get_admin_keyboard()
+        )
+        return
+
+    file = await document.get_file()
+    data = await file.download_as_bytearray()
+    rows, invalid = parse_code_import(data.decode('utf-8', errors='replace'))
+    added, duplicates = import_redeem_codes(rows)
+    await update.message.reply_text(
+        f"✅ Imported {added} codes\n"
+        f"Duplicates skipped: {duplicates}\n"
+        f"Invalid lines: {invalid}\n\n" + format_code_stock(),
+        reply_markup=get_admin_keyboard()
+    )
+
+# Update intake settings (deployment specific, so read from the environment)
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')  # 'polling' or 'webhook'
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')  # Public HTTPS URL Telegram posts updates to
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')  # Address the webhook server binds
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))  # Port the webhook server binds
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')  # URL path of the webhook endpoint
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or None  # Checked against Telegram's secret header
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')  # Point at a fake server for testing
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', '32'))  # Updates processed concurrently
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', '1000'))  # Updates accepted before intake blocks
+PIPELINE_STATS_INTERVAL = 60  # Seconds between update pipeline log lines
+
+# Only the update types the handlers use
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# The application moves updates out of its queue into tasks immediately, so a
+# plain maxsize would not limit anything. This queue counts an update from
+# put() until task_done() (called once the update has been handled) and makes
+# put() wait while too many are in flight, which pushes back on the webhook
+# server or the polling loop.
+class UpdateQueue(asyncio.Queue):
+    def __init__(self, limit: int):
+        super().__init__()
+        self.limit = limit
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.blocked_puts = 0
+        self.blocked_seconds = 0.0
+        self.has_room = asyncio.Event()
+
+    async def put(self, item) -> None:
+        if isinstance(item, Update):
+            if self.in_flight >= self.limit:
+                self.blocked_puts += 1
+                started = time.perf_counter()
+                while self.in_flight >= self.limit:
+                    self.has_room.clear()
+                    await self.has_room.wait()
+                self.blocked_seconds += time.perf_counter() - started
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await super().put(item)
+
+    def task_done(self) -> None:
+        super().task_done()
+        self.release()
+
+    def hold(self) -> None:
+        # Keeps an update counted past its task_done(), while it waits in a
+        # per-user backlog; paired with release() once it has run
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def release(self) -> None:
+        if self.in_flight > 0:
+            self.in_flight -= 1
+            self.has_room.set()
+
+# Runs updates from different users in parallel (up to the worker limit) while
+# keeping each user's updates in arrival order. A user's later updates are
+# parked behind the one being processed and drained by the same worker, so
+# they never occupy extra worker slots while waiting. Parked updates stay
+# counted against the update queue's limit, so a single chatty user can't
+# grow the backlog past it.
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int, update_queue: UpdateQueue = None):
+        super().__init__(max_concurrent_updates)
+        self.update_queue = update_queue
+        self.backlogs = {}
+        self.processed = 0
+        self.deferred = 0
+        self.parked = 0
+        self.max_backlog = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def run(self, coroutine) -> None:
+        try:
+            await coroutine
+        except Exception as e:
+            logging.error(f"Error processing update: {e}")
+        self.processed += 1
+
+    async def do_process_update(self, update, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await self.run(coroutine)
+            return
+
+        backlog = self.backlogs.get(user.id)
+        if backlog is not None:
+            backlog.append(coroutine)
+            if self.update_queue is not None:
+                self.update_queue.hold()
+            self.deferred += 1
+            self.parked += 1
+            self.max_backlog = max(self.max_backlog, len(backlog))
+            return
+
+        backlog = self.backlogs[user.id] = deque()
+        try:
+            await self.run(coroutine)
+            while backlog:
+                parked = backlog.popleft()
+                try:
+                    await self.run(parked)
+                finally:
+                    self.unpark()
+        finally:
+            del self.backlogs[user.id]
+            for leftover in backlog:
+                leftover.close()
+                self.unpark()
+
+    def unpark(self) -> None:
+        self.parked -= 1
+        if self.update_queue is not None:
+            self.update_queue.release()
+
+# Pipeline stats that only ever grow; the rest are current or peak values
+PIPELINE_COUNTERS = {'blocked_puts', 'blocked_seconds', 'processed', 'deferred'}
+
+def get_pipeline_stats(application: Application) -> dict:
+    queue = application.update_queue
+    processor = application.update_processor
+    stats = {'mode': BOT_MODE, 'workers': processor.max_concurrent_updates,
+             'running': processor.current_concurrent_updates}
+    if isinstance(queue, UpdateQueue):
+        stats.update(in_flight=queue.in_flight, limit=queue.limit, max_in_flight=queue.max_in_flight,
+                     blocked_puts=queue.blocked_puts, blocked_seconds=round(queue.blocked_seconds, 3))
+    if isinstance(processor, PerUserUpdateProcessor):
+        stats.update(processed=processor.processed, deferred=processor.deferred, parked=processor.parked,
+                     users_with_backlog=len(processor.backlogs), max_backlog=processor.max_backlog)
+    return stats
+
+async def log_pipeline_stats(application: Application) -> None:
+    while True:
+        await asyncio.sleep(PIPELINE_STATS_INTERVAL)
+        logging.info(f"Update pipeline: {get_pipeline_stats(application)}")
+
+# Wraps the bot's HTTP backend to time every Bot API call by method name.
+# Responses with an error status and transport failures count as errors.
+class InstrumentedRequest(BaseRequest):
+    def __init__(self, request: BaseRequest):
+        self.request = request
+
+    @property
+    def read_timeout(self):
+        return self.request.read_timeout
+
+    async def initialize(self) -> None:
+        await self.request.initialize()
+
+    async def shutdown(self) -> None:
+        await self.request.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data=None, **timeouts) -> tuple:
+        histogram = get_histogram(api_metrics, url.rsplit('/', 1)[-1])
+        started = time.perf_counter()
+        failed = True
+        try:
+            code, payload = await self.request.do_request(url, method, request_data, **timeouts)
+            failed = code >= 400
+            return code, payload
+        finally:
+            histogram.observe(time.perf_counter() - started, failed)
+
+def render_histograms(lines: list, metric: str, label: str, registry: dict) -> None:
+    lines.append(f"# TYPE {metric}_seconds histogram")
+    for name, histogram in registry.items():
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+            cumulative += count
+            lines.append(f'{metric}_seconds_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_seconds_bucket{{{label}="{name}",le="+Inf"}} {histogram.count}')
+        lines.append(f'{metric}_seconds_sum{{{label}="{name}"}} {histogram.sum:.6f}')
+        lines.append(f'{metric}_seconds_count{{{label}="{name}"}} {histogram.count}')
+    lines.append(f"# TYPE {metric}_errors_total counter")
+    for name, histogram in registry.items():
+        lines.append(f'{metric}_errors_total{{{label}="{name}"}} {histogram.errors}')
+
+def render_metrics(application: Application) -> str:
+    # Prometheus text exposition format
+    lines = []
+    render_histograms(lines, 'earn4cash_handler', 'handler', handler_metrics)
+    render_histograms(lines, 'earn4cash_route', 'route', router.stats)
+    render_histograms(lines, 'earn4cash_api', 'method', api_metrics)
+
+    # Each metric family is one contiguous group under its own TYPE line
+    for index, family in enumerate(('hits', 'misses')):
+        lines.append(f"# TYPE earn4cash_cache_{family}_total counter")
+        for name, counts in cache_stats.items():
+            lines.append(f'earn4cash_cache_{family}_total{{cache="{name}"}} {counts[index]}')
+
+    for key, value in get_pipeline_stats(application).items():
+        if isinstance(value, (int, float)):
+            kind = 'counter' if key in PIPELINE_COUNTERS else 'gauge'
+            lines.append(f"# TYPE earn4cash_pipeline_{key} {kind}")
+            lines.append(f"earn4cash_pipeline_{key} {value}")
+    for key in ('sent', 'failed', 'dropped', 'retried'):
+        lines.append(f"# TYPE earn4cash_send_{key}_total counter")
+        lines.append(f"earn4cash_send_{key}_total {getattr(send_queue, key)}")
+    lines.append("# TYPE earn4cash_users gauge")
+    lines.append(f"earn4cash_users {count_users()}")
+    return "\n".join(lines) + "\n"
+
+async def serve_metrics(application: Application) -> None:
+    # Minimal HTTP endpoint for Prometheus scrapes: GET /metrics, nothing else
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                status, body = "200 OK", render_metrics(application).encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logging.error(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, METRICS_LISTEN, METRICS_PORT)
+    logging.info(f"Serving metrics on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    async with server:
+        await server.serve_forever()
+
+# Long-running tasks started with the application and cancelled on shutdown
+background_tasks = []
+
+async def on_startup(application: Application) -> None:
+    send_queue.start(application.bot)
+    background_tasks.append(asyncio.create_task(log_pipeline_stats(application)))
+    if METRICS_PORT:
+        background_tasks.append(asyncio.create_task(serve_metrics(application)))
+
+    background_tasks.append(asyncio.create_task(watch_config()))
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_config, 'SIGHUP')
+    except (AttributeError, NotImplementedError):
+        pass  # No SIGHUP on Windows; the file watcher still picks up changes
+
+    if application.job_queue is None:
+        logging.warning("JobQueue unavailable (install python-telegram-bot[job-queue]); daily bonus and conversation sweeps disabled")
+    else:
+        first = BONUS_BUCKET_SECONDS - time.time() % BONUS_BUCKET_SECONDS + 1
+        application.job_queue.run_repeating(sweep_daily_bonus, interval=BONUS_BUCKET_SECONDS, first=first,
+                                            name='daily_bonus_sweep')
+        application.job_queue.run_repeating(sweep_conversations, interval=CONVERSATION_SWEEP_INTERVAL,
+                                            name='conversation_sweep')
 
 def main() -> None:
-    # Replace 'YOUR_BOT_TOKEN' with your actual bot token
-    application = Application.builder().token('7769152908:AAH2QeJ9bnIpOjXHJIK9HNmIcf-pxYYauL0').build()
+    # Settings first, since the token and the cached UI depend on them
+    apply_config(read_config(), startup=True)
+    if not BOT_TOKEN:
+        raise SystemExit(f"BOT_TOKEN is not set; add it to {CONFIG_PATH} or the environment")
+
+    # Load persisted state before accepting updates
+    storage.open()
+    storage.load()
+
+    # Build the shared keyboards and static texts once
+    build_ui_cache()
+
+    update_queue = UpdateQueue(UPDATE_QUEUE_SIZE)
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .request(InstrumentedRequest(HTTPXRequest(connection_pool_size=256)))
+        .update_queue(update_queue)
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_WORKERS, update_queue))
+        .persistence(ConversationPersistence())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("topreferrers", top_referrers_command))
+    application.add_handler(CommandHandler("referrals", referral_info_command))
+    application.add_handler(CommandHandler("bursts", referral_bursts_command))
     application.add_handler(CallbackQueryHandler(button_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_code_import))
     
     # Start the bot
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook':
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=UPDATE_WORKERS,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
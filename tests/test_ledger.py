@@ -0,0 +1,93 @@
+# Money paths replayed through the real handlers against the fake Bot API from
+# loadtest.py. Telegram redelivers an update when the bot restarts before
+# confirming it, so every balance change has to be safe to apply twice.
+import asyncio
+
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters
+
+import main
+from loadtest import FakeBotAPI, UpdateFactory
+
+USER_ID = 42
+
+async def start_bot(tmp_path) -> Application:
+    main.storage.path = str(tmp_path / 'test.db')
+    main.storage.open()
+    main.storage.load()
+    main.build_ui_cache()
+    application = Application.builder().token('1:test').request(FakeBotAPI()).build()
+    application.add_handler(CommandHandler("start", main.start))
+    application.add_handler(CallbackQueryHandler(main.button_handler))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, main.handle_message))
+    await application.initialize()
+    return application
+
+async def stop_bot(application: Application) -> None:
+    await application.shutdown()
+    main.storage.close()
+
+def test_redelivered_withdrawal_is_filed_once(tmp_path):
+    async def scenario():
+        application = await start_bot(tmp_path)
+        factory = UpdateFactory(application.bot)
+        amount = main.WITHDRAWAL_AMOUNTS[0]
+        await application.process_update(factory.start(USER_ID))
+        async with main.lock_users(USER_ID):
+            main.post_ledger_entry(USER_ID, 500, 'test')
+
+        upi = factory.text(USER_ID, 'user@upi')
+        await application.process_update(factory.callback(USER_ID, f"amount_{amount}"))
+        await application.process_update(upi)
+        # The conversation is open again, as when it is restored after a restart
+        await application.process_update(factory.callback(USER_ID, f"amount_{amount}"))
+        await application.process_update(upi)
+
+        assert main.users[USER_ID].balance == 500 - amount
+        assert [request.user_id for request in main.withdrawal_queue.pending.values()] == [USER_ID]
+        await stop_bot(application)
+
+    asyncio.run(scenario())
+
+def test_redelivered_redeem_request_issues_one_code(tmp_path):
+    async def scenario():
+        application = await start_bot(tmp_path)
+        factory = UpdateFactory(application.bot)
+        amount = main.REDEEM_AMOUNTS[0]
+        await application.process_update(factory.start(USER_ID))
+        async with main.lock_users(USER_ID):
+            main.post_ledger_entry(USER_ID, 500, 'test')
+
+        request = factory.callback(USER_ID, f"redeem_{amount}")
+        await application.process_update(request)
+        await application.process_update(request)
+
+        assert main.users[USER_ID].balance == 500 - amount
+        assert list(main.redeem_pool.issued_to.values()) == [USER_ID]
+        await stop_bot(application)
+
+    asyncio.run(scenario())
+
+def test_stock_code_cannot_be_redeemed_without_being_issued():
+    pool = main.RedeemCodePool()
+    pool.add('SEED300', 300)
+    assert pool.redeem('SEED300', USER_ID) == (main.CODE_AVAILABLE, None)
+    assert pool.issue(300, USER_ID) == 'SEED300'
+    assert pool.redeem('SEED300', USER_ID + 1) == (main.CODE_ISSUED, None)
+    assert pool.redeem('SEED300', USER_ID) == (main.CODE_ISSUED, 300)
+    assert pool.redeem('SEED300', USER_ID) == (main.CODE_REDEEMED, None)
+
+def test_failing_storage_write_is_dropped_and_the_rest_committed(tmp_path):
+    main.storage.path = str(tmp_path / 'test.db')
+    main.storage.open()
+    main.storage.load()
+    main.users[USER_ID] = main.UserRecord(balance=70)
+    main.storage.mark_user_dirty(USER_ID)
+    main.storage.write(main.Storage.INSERT_LEDGER, (USER_ID, None, 'test', None, 0.0))  # NOT NULL violation
+    main.storage.write(main.Storage.INSERT_LEDGER, (USER_ID, 70, 'test', None, 0.0))
+
+    assert main.storage.flush()
+    assert not main.storage.pending and not main.storage.failures
+    conn = main.storage.conn
+    assert conn.execute("SELECT balance FROM users WHERE user_id = ?", (USER_ID,)).fetchone() == (70,)
+    assert conn.execute("SELECT delta FROM ledger WHERE user_id = ?", (USER_ID,)).fetchall() == [(70,)]
+    main.storage.close()
@@ -0,0 +1,32 @@
+from telegram.ext import Application
+
+import main
+from loadtest import FakeBotAPI
+
+def test_metric_families_are_contiguous_and_typed():
+    update_queue = main.UpdateQueue(10)
+    application = (
+        Application.builder()
+        .token('1:test')
+        .request(FakeBotAPI())
+        .update_queue(update_queue)
+        .concurrent_updates(main.PerUserUpdateProcessor(4, update_queue))
+        .build()
+    )
+    main.count_cache('ui', True)
+    main.count_cache('membership', False)
+
+    typed = set()
+    finished = set()
+    current = None
+    for line in main.render_metrics(application).splitlines():
+        if line.startswith('# TYPE '):
+            typed.add(line.split()[2])
+            continue
+        name = line.split('{')[0].split()[0]
+        family = name.rsplit('_', 1)[0] if name.endswith(('_bucket', '_sum', '_count')) else name
+        if family != current:
+            assert family not in finished, f"{family} is split into several groups"
+            finished.add(current)
+            current = family
+        assert family in typed, f"{family} has no TYPE line"